@@ -26,6 +26,31 @@ def create_app(test_config=None):
     app.config.from_mapping(
             SECRET_KEY='dev',
             DATABASE=os.path.join(app.instance_path, 'doublecheck.sqlite'),
+            # Keep a db connection open per worker thread instead of connecting
+            #   on every request
+            DATABASE_PERSISTENT_CONNECTIONS=True,
+            # Applied to every new db connection
+            SQLITE_PRAGMAS={
+                'journal_mode': 'WAL',
+                'synchronous': 'NORMAL',
+                # negative means KiB, so 64MB of page cache per connection
+                'cache_size': -64000,
+                'mmap_size': 256*1024*1024,
+                'busy_timeout': 5000,
+                'temp_store': 'MEMORY',
+                },
+            # Writes which still find the database locked after busy_timeout
+            #   are retried this many times, backing off from this many seconds
+            DATABASE_WRITE_RETRIES=5,
+            DATABASE_WRITE_BACKOFF=0.05,
+            # Queue all writes through a single writer thread
+            DATABASE_WRITER_THREAD=False,
+            # Time every query, including fetching its rows; queries slower
+            #   than the threshold are explained, logged and listed on the
+            #   admin query page. Off by default, as timing each row slows
+            #   down pages which fetch many of them
+            QUERY_LOG=False,
+            SLOW_QUERY_THRESHOLD_MS=100,
             # Registration is disabled by default, can be enabled via admin control panel
             REGISTRATION_ENABLED=False,
             # First user created will have admin role by default
@@ -33,7 +58,46 @@ def create_app(test_config=None):
             # Max content length controls the allowed size of uploaded files, defaults to 16MB
             MAX_CONTENT_LENGTH=16*1000*1000,
             # Allowed filetypes for upload, defaults to .txt and .pgn
-            ALLOWED_FILETYPES=['txt','pgn']
+            ALLOWED_FILETYPES=['txt','pgn'],
+            # Number of posts shown per page on the index
+            POSTS_PER_PAGE=10,
+            # Send the index as it is rendered, a post at a time
+            INDEX_STREAMING=True,
+            # Number of users shown per page in the admin user control panel
+            USERS_PER_PAGE=50,
+            # Number of rendered board images kept in memory by each worker
+            BOARD_CACHE_SIZE=1024,
+            # Rendered board images are also saved here and shared between workers,
+            #   set to None to only cache them in memory
+            BOARD_CACHE_DIR=os.path.join(app.instance_path, 'board_cache'),
+            # Seconds browsers and proxies may keep a board image; the image at
+            #   a board url never changes, so this can be as long as you like
+            BOARD_IMAGE_MAX_AGE=31536000,
+            # Where session data is kept: 'sqlite' (shared by all workers),
+            #   'memory' (single worker/testing) or 'cookie' (Flask's signed cookie)
+            SESSION_BACKEND='sqlite',
+            SESSION_DATABASE=os.path.join(app.instance_path, 'sessions.sqlite'),
+            # Passwords are hashed with this werkzeug method, written out in full
+            #   as it appears at the start of stored hashes; older hashes are
+            #   replaced the next time their user logs in
+            PASSWORD_HASH_METHOD='scrypt:32768:8:1',
+            # Hashing runs in this many worker processes (0 hashes on the request
+            #   thread), with at most PASSWORD_HASH_MAX_PENDING hashes queued or
+            #   running, each waiting up to PASSWORD_HASH_TIMEOUT seconds
+            PASSWORD_HASH_WORKERS=2,
+            PASSWORD_HASH_MAX_PENDING=8,
+            PASSWORD_HASH_TIMEOUT=10,
+            # Number of logged in users kept in memory by each worker, and for
+            #   how many seconds
+            USER_CACHE_SIZE=512,
+            USER_CACHE_TTL=30,
+            # Number of games kept in memory by each worker for game viewing
+            GAME_CACHE_SIZE=256,
+            # Seconds browsers may cache a game's positions.json before revalidating
+            GAME_POSITIONS_MAX_AGE=86400,
+            # Step through games in the browser (when javascript is available)
+            #   instead of posting every move back to the server
+            GAME_VIEW_CLIENT_STEPPING=True
             )
 
     if test_config is None:
@@ -62,8 +126,21 @@ def create_app(test_config=None):
     from . import db
     db.init_app(app)
 
+    from . import settings
+    settings.init_app(app)
+
+    from . import boards
+    boards.init_app(app)
+
+    from . import sessions
+    sessions.init_app(app)
+
+    from . import passwords
+    passwords.init_app(app)
+
     from . import auth
     app.register_blueprint(auth.bp)
+    auth.init_app(app)
     # inject auth roles into app context for access via jinja templates
     @app.context_processor
     def inject_roles():
@@ -78,6 +155,7 @@ def create_app(test_config=None):
 
     from . import game
     app.register_blueprint(game.bp)
+    game.init_app(app)
 
     # apply proxyfix to support nginx proxy in front of the app
     app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1, x_prefix=1)
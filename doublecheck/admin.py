@@ -16,10 +16,13 @@
 from flask import (
         abort, current_app, Blueprint, flash, g, redirect, render_template, request, url_for
         )
-from doublecheck.auth import Roles, admin_required
-from doublecheck.db import get_db
-
-from werkzeug.security import generate_password_hash
+from doublecheck.auth import BUSY_MESSAGE, Roles, admin_required, invalidate_user
+from doublecheck.boards import get_board_cache
+from doublecheck.db import get_db, run_write
+from doublecheck.models import User
+from doublecheck.passwords import PasswordHasherBusy, hash_password
+from doublecheck.querylog import get_query_log
+from doublecheck.settings import update_settings
 
 from enum import Enum, auto
 import datetime
@@ -35,67 +38,156 @@ def index():
     if request.method == 'POST':
         config_values = {e.name: True if request.form[e.name] == 'True' else False for e in CONFIG_OPTIONS}
         flash(str(config_values)) # DEBUG
-        for config_value in config_values:
-            current_app.config[config_value] = config_values[config_value]
+        # saved as settings, so every worker picks them up
+        update_settings(config_values)
         return redirect(url_for('index'))
 
-    return render_template('admin/index.html', config_options=CONFIG_OPTIONS, current_app=current_app)
+    return render_template('admin/index.html', config_options=CONFIG_OPTIONS, current_app=current_app, board_cache_stats=get_board_cache().stats())
+
+@bp.route('/queries', methods=('GET','POST'))
+@admin_required
+def queries():
+    query_log = get_query_log()
+    if query_log is None:
+        flash('Query logging is disabled, set QUERY_LOG to enable it')
+        return redirect(url_for('admin.index'))
+
+    if request.method == 'POST':
+        query_log.clear()
+        return redirect(url_for('admin.queries'))
+
+    return render_template('admin/queries.html', slowest=query_log.slowest(), scans=query_log.scans(),
+                           slow_queries=query_log.slow_queries(), slow_ms=query_log.slow_ms)
+
+# sortable user_cp columns, each tie-broken by id so pages are stable
+USER_SORTS = {
+        'role': 'role {dir}, id ASC',
+        'id': 'id {dir}',
+        'username': 'username {dir}',
+        'member_number': 'member_number {dir}, id ASC',
+        'created': 'created {dir}, id ASC',
+        'last_login': 'last_login {dir}, id ASC',
+        }
+
+def prefix_range(prefix):
+    # "username starts with prefix" as a range, so it can use the index
+    #   (LIKE 'prefix%' can't, since LIKE is case-insensitive)
+    return (prefix, prefix + '\U0010ffff')
+
+def get_user_page(args, per_page):
+    where = []
+    params = []
+    username = args.get('username', '').strip()
+    if username != '':
+        where.append('username >= ? AND username < ?')
+        params.extend(prefix_range(username))
+    member_number = args.get('member_number', '').strip()
+    if member_number != '':
+        where.append('member_number >= ? AND member_number < ?')
+        params.extend(prefix_range(member_number))
+    role = args.get('role', '')
+    if role.isdigit():
+        where.append('role = ?')
+        params.append(int(role))
+    active = args.get('active', '')
+    if active in ('0', '1'):
+        where.append('active = ?')
+        params.append(int(active))
+    where_str = f' WHERE {" AND ".join(where)}' if where else ''
+
+    sort = args.get('sort', 'role')
+    if sort not in USER_SORTS:
+        sort = 'role'
+    direction = 'ASC' if args.get('dir', 'desc' if sort == 'role' else 'asc') == 'asc' else 'DESC'
+    page = max(args.get('page', 1, type=int), 1)
+
+    db = get_db()
+    total = db.execute(f'SELECT count(*) FROM user{where_str}', params).fetchone()[0]
+    rows = db.execute(
+            f'SELECT {User.columns()} FROM user{where_str}'
+            f' ORDER BY {USER_SORTS[sort].format(dir=direction)}'
+            ' LIMIT ? OFFSET ?',
+            params + [per_page, (page-1)*per_page]
+            )
+    users = [User.from_row(e) for e in rows]
+    page_count = max((total + per_page - 1) // per_page, 1)
+    return users, {'total': total, 'page': page, 'page_count': page_count, 'sort': sort, 'dir': direction.lower()}
+
+def bulk_update_users(action, user_ids, role=None):
+    # everything happens in one transaction; admins can't deactivate or
+    #   change the role of their own account this way
+    user_ids = [e for e in user_ids if e != g.user.id]
+    if len(user_ids) == 0:
+        return 0
+    placeholders = ', '.join('?' for e in user_ids)
+    if action == 'activate':
+        query = f'UPDATE user SET active = 1, deactivated_on = null WHERE id IN ({placeholders}) AND active = 0'
+        params = user_ids
+    elif action == 'deactivate':
+        query = f'UPDATE user SET active = 0, deactivated_on = current_timestamp WHERE id IN ({placeholders}) AND active = 1'
+        params = user_ids
+    elif action == 'role' and role is not None:
+        query = f'UPDATE user SET role = ? WHERE id IN ({placeholders})'
+        params = [role] + user_ids
+    else:
+        return 0
+    count = run_write(lambda db: db.execute(query, params).rowcount)
+    for user_id in user_ids:
+        invalidate_user(user_id)
+    return count
 
 @bp.route('/user_cp', methods=('GET','POST'))
 @admin_required
 def user_cp():
-    db = get_db()
+    # the current filters, sort and page are kept through posts and redirects
+    this_page = url_for('admin.user_cp', **request.args.to_dict())
 
     if request.method == 'POST':
         # Check action: Deactivate user
         deactivate_id = request.form.get('deactivate')
         if deactivate_id is not None:
             # make sure we cannot deactivate our own account here
-            if int(deactivate_id) != int(g.user['id']):
-                user_deactivate = db.execute(
+            if int(deactivate_id) != g.user.id:
+                user_deactivate = run_write(lambda db: db.execute(
                         'UPDATE user'
                         ' SET active = 0,'
                         '   deactivated_on = current_timestamp'
                         ' WHERE id = ?',
                         (deactivate_id,)
-                        )
-                db.commit()
+                        ))
+                invalidate_user(deactivate_id)
                 flash(f'deactivate user {deactivate_id}, result: {user_deactivate}')
             else: 
                 flash(f'cannot deactivate your own account here')
-            return redirect(url_for('admin.user_cp'))
+            return redirect(this_page)
         # Check action: Activate user
         activate_id = request.form.get('activate')
         if activate_id is not None:
-            user_activate = db.execute(
+            user_activate = run_write(lambda db: db.execute(
                     'UPDATE user'
                     ' SET active = 1,'
                     '   deactivated_on = null'
                     ' WHERE id = ?',
                     (activate_id,)
-                    )
-            db.commit()
+                    ))
+            invalidate_user(activate_id)
             flash(f'activate user {activate_id}, result: {user_activate}')
-            return redirect(url_for('admin.user_cp'))
+            return redirect(this_page)
+        # Check action: Bulk update of the checked users
+        bulk_action = request.form.get('bulk_action')
+        if bulk_action is not None:
+            user_ids = [int(e) for e in request.form.getlist('user_id') if e.isdigit()]
+            role = request.form.get('bulk_role')
+            role = Roles[role].value if role in Roles.__members__ else None
+            count = bulk_update_users(bulk_action, user_ids, role=role)
+            flash(f'{bulk_action}: updated {count} of {len(user_ids)} selected user(s)')
+            return redirect(this_page)
         else:
             flash(f'POST received, request.form = {str(request.form)}')
 
-    # GET request: populate list of users into template
-    users = db.execute('SELECT id, member_number, username, display_name, role, created, last_login, active, deactivated_on FROM user ORDER BY role DESC, id ASC')
-    users = [dict(e) for e in users]
-    rolename_list = [e.title() for e in list(Roles.__members__)]
-    for user in users:
-        # This is where we could apply the current user's timezone offset (from
-        #   preferences) to the datetimes retrieved from the db
-        # No idea why pyright thinks user['created'] is a str here,
-        #   it's a datetime.datetime
-        #print((user['created']-datetime.timedelta(hours=6)).strftime('%Y-%m-%d %H:%M:%S')) # pyright: ignore
-        user['rolename'] = rolename_list[int(user['role'])-1]
-        # Change None to blank string for all columns in each record
-        for key in user.keys():
-            if user[key] is None:
-                user[key] = ''
-    return render_template('admin/user_cp.html', users=users)
+    # GET request: populate one page of users into the template
+    users, pager = get_user_page(request.args, current_app.config['USERS_PER_PAGE'])
+    return render_template('admin/user_cp.html', users=users, pager=pager, filters=request.args.to_dict())
 
 @bp.route('/user_edit/<int:id>', methods=('GET','POST'))
 @admin_required
@@ -125,7 +217,11 @@ def user_edit(id):
                     if attribute != request.form.get('confirm_new_password'):
                         flash("Password must match confirmation")
                         return redirect(url_for('admin.user_edit', id=id))
-                    attribute = generate_password_hash(attribute)
+                    try:
+                        attribute = hash_password(attribute)
+                    except PasswordHasherBusy:
+                        flash(BUSY_MESSAGE)
+                        return redirect(url_for('admin.user_edit', id=id))
                 # Convert role from string (e.g. 'Roles.USER') to
                 #   int via Enum
                 elif attribute_str == 'role':
@@ -136,12 +232,12 @@ def user_edit(id):
             # Remove leading comma + space
             query_str = query_str[2:]
             full_query_str = f'UPDATE user SET {query_str} WHERE id = {id}'
-            db.execute(full_query_str, query_vars)
-            db.commit()
+            run_write(lambda db: db.execute(full_query_str, query_vars))
+            invalidate_user(id)
         return redirect(url_for('admin.user_cp'))
 
     user_data = db.execute(
-            'SELECT *'
+            'SELECT id, username, password, role, created, active, deactivated_on, display_name, member_number, last_login, timezone'
             ' FROM user'
             ' WHERE id = ?',
             (id,)
@@ -168,8 +264,6 @@ def user_edit(id):
 @bp.route('/user_add', methods=('GET','POST'))
 @admin_required
 def user_add():
-    db = get_db()
-
     # TODO: Replace this with a data model
     attributes = ['username', 'password', 'role', 'display_name', 'member_number', 'timezone']
 
@@ -187,7 +281,11 @@ def user_add():
                     attribute = None
                 # Generate hash for password
                 elif attribute_str == 'password':
-                    attribute = generate_password_hash(attribute)
+                    try:
+                        attribute = hash_password(attribute)
+                    except PasswordHasherBusy:
+                        flash(BUSY_MESSAGE)
+                        return redirect(url_for('admin.user_add'))
                 # Convert role from string (e.g. 'Roles.USER') to
                 #   int via Enum
                 elif attribute_str == 'role':
@@ -203,8 +301,7 @@ def user_add():
             query_str = f'({query_str})'
             query_cols = f'({query_cols})'
             full_query_str = f'INSERT INTO user {query_cols} VALUES {query_str}'
-            db.execute(full_query_str, query_vars)
-            db.commit()
+            run_write(lambda db: db.execute(full_query_str, query_vars))
         return redirect(url_for('admin.user_cp'))
 
     user_params = {}
@@ -14,13 +14,17 @@
 #You should have received a copy of the GNU Affero General Public License
 #along with this program.  If not, see <https://www.gnu.org/licenses/>.
 import functools
+import sqlite3
 
 from flask import (
         Blueprint, current_app, flash, g, redirect, render_template, request, session, url_for
         )
-from werkzeug.security import check_password_hash, generate_password_hash
 
-from doublecheck.db import get_db
+from doublecheck.cache import LRUCache
+from doublecheck.db import get_db, run_write
+from doublecheck.models import User
+from doublecheck.passwords import PasswordHasherBusy, check_password, get_password_hasher, hash_password
+from doublecheck.settings import first_user_is_admin, update_settings
 
 from enum import Enum
 
@@ -34,18 +38,13 @@ class Roles(Enum):
 
 bp = Blueprint('auth', __name__, url_prefix='/auth')
 
+BUSY_MESSAGE = 'Too many people are logging in right now, please try again in a moment'
+
 @bp.route('/register', methods=('GET','POST'))
 def register():
-    # If config is set up to create first user as admin,
-    #   we should first confirm this config by checking the
-    #   db state
-    create_first_user_as_admin = current_app.config.get('CREATE_FIRST_USER_AS_ADMIN', False)
-    if create_first_user_as_admin:
-        db = get_db()
-        result = db.execute('SELECT count(id) as user_count FROM user').fetchone()
-        if result['user_count'] != 0:
-            current_app.config['CREATE_FIRST_USER_AS_ADMIN'] = False
-            create_first_user_as_admin = False
+    # If config is set up to create first user as admin (which is
+    #   turned off once there are any users, see settings.py)
+    create_first_user_as_admin = first_user_is_admin()
 
     # If registration is not enabled, redirect to the index
     registration_enabled = current_app.config.get('REGISTRATION_ENABLED', False)
@@ -61,7 +60,6 @@ def register():
         display_name = request.form.get('display_name', '')
         member_number = request.form.get('member_number', '')
         timezone = request.form.get('timezone', '')
-        db = get_db()
         error = None
 
         if username == '':
@@ -74,15 +72,17 @@ def register():
         if error is None:
             try:
                 new_user_role = Roles.ADMIN.value if create_first_user_as_admin else Roles.USER.value
-                db.execute('INSERT INTO user (username, password, role, display_name, member_number, timezone) VALUES (?, ?, ?, ?, ?, ?)',
-                           (username, generate_password_hash(password), new_user_role, display_name, member_number, timezone)
-                           )
-                db.commit()
-            except db.IntegrityError:
+                password_hash = hash_password(password)
+                run_write(lambda db: db.execute('INSERT INTO user (username, password, role, display_name, member_number, timezone) VALUES (?, ?, ?, ?, ?, ?)',
+                           (username, password_hash, new_user_role, display_name, member_number, timezone)
+                           ))
+            except PasswordHasherBusy:
+                error = BUSY_MESSAGE
+            except sqlite3.IntegrityError:
                 error = f'User {username} is already registered'
             else:
                 if create_first_user_as_admin:
-                    current_app.config['CREATE_FIRST_USER_AS_ADMIN'] = False
+                    update_settings({'CREATE_FIRST_USER_AS_ADMIN': False})
                 return redirect(url_for('auth.login'))
 
         flash(error)
@@ -96,20 +96,33 @@ def login():
         password = request.form.get('password', '')
         db = get_db()
         error = None
-        user = db.execute('SELECT * FROM user WHERE username = ?', (username,)).fetchone()
-
-        if user is None:
-            error = 'Invalid username'
-        elif not check_password_hash(user['password'], password):
-            error = 'Invalid password'
-        elif user['active'] == 0:
-            error = 'Deactivated account'
+        user = db.execute('SELECT id, password, active FROM user WHERE username = ?', (username,)).fetchone()
+
+        try:
+            if user is None:
+                error = 'Invalid username'
+            elif not check_password(user['password'], password):
+                error = 'Invalid password'
+            elif user['active'] == 0:
+                error = 'Deactivated account'
+        except PasswordHasherBusy:
+            error = BUSY_MESSAGE
 
         if error is None:
             session.clear()
             session['user_id'] = user['id']
-            db.execute('UPDATE user SET last_login = current_timestamp where id = ?', (user['id'],))
-            db.commit()
+            run_write(lambda db: db.execute('UPDATE user SET last_login = current_timestamp where id = ?', (user['id'],)))
+            # hashes made with other parameters than the configured ones are
+            #   replaced while we have the password; if the hasher is too busy
+            #   it can wait for the next login
+            if get_password_hasher().needs_rehash(user['password']):
+                try:
+                    password_hash = hash_password(password)
+                except PasswordHasherBusy:
+                    pass
+                else:
+                    run_write(lambda db: db.execute('UPDATE user SET password = ? where id = ?', (password_hash, user['id'])))
+            invalidate_user(user['id'])
             return redirect(url_for('index'))
 
         flash(error)
@@ -125,10 +138,28 @@ def logout():
 def load_logged_in_user():
     user_id = session.get('user_id')
 
-    if user_id is None:
+    # static files never need to know who is asking
+    if user_id is None or request.endpoint == 'static':
         g.user = None
     else:
-        g.user = get_db().execute('SELECT * FROM user WHERE id = ?', (user_id,)).fetchone()
+        g.user = get_user(user_id)
+
+def get_user(user_id):
+    # users are cached per worker for a short while, and dropped from the cache
+    #   whenever they are changed here; changes made by other workers show up
+    #   once the entry expires
+    user_cache = current_app.extensions['user_cache']
+    user = user_cache.get(user_id)
+    if user is None:
+        row = get_db().execute(f'SELECT {User.columns()} FROM user WHERE id = ?', (user_id,)).fetchone()
+        if row is None:
+            return None
+        user = User.from_row(row)
+        user_cache.put(user_id, user)
+    return user
+
+def invalidate_user(user_id):
+    current_app.extensions['user_cache'].pop(int(user_id))
 
 def login_required(view):
     @functools.wraps(view)
@@ -142,8 +173,11 @@ def login_required(view):
 def admin_required(view):
     @functools.wraps(view)
     def wrapped_view(**kwargs):
-        if g.user is None or g.user['role'] != Roles.ADMIN.value:
+        if g.user is None or g.user.role != Roles.ADMIN.value:
             return redirect(url_for('index'))
 
         return view(**kwargs)
     return wrapped_view
+
+def init_app(app):
+    app.extensions['user_cache'] = LRUCache(app.config['USER_CACHE_SIZE'], ttl=app.config['USER_CACHE_TTL'])
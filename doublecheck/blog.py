@@ -14,60 +14,171 @@
 #You should have received a copy of the GNU Affero General Public License
 #along with this program.  If not, see <https://www.gnu.org/licenses/>.
 from flask import (
-        Blueprint, current_app, flash, g, redirect, render_template, request, url_for
+        Blueprint, current_app, flash, g, redirect, render_template, request, session, stream_template, url_for
         )
-from markupsafe import Markup
 from werkzeug.datastructures import FileStorage
 from werkzeug.exceptions import abort
 from werkzeug.utils import secure_filename
 
 from doublecheck.auth import login_required
-from doublecheck.db import get_db
+from doublecheck.boards import board_placement
+from doublecheck.conditional import add_validators, not_modified, page_etag
+from doublecheck.db import get_db, run_write
+from doublecheck.models import Post
+from doublecheck.pgn import (
+        StagedGames, decompress_pgn, derive_game_data, ingest_pgn, read_summary, save_game_file
+        )
 
-import chess.pgn, chess.svg
 import io
 
 bp = Blueprint('blog', __name__)
 
 @bp.route('/')
 def index():
-    # If config is set up to create first user as admin,
-    #   we should first confirm this config by checking the
-    #   db state
-    create_first_user_as_admin = current_app.config.get('CREATE_FIRST_USER_AS_ADMIN', False)
-    if create_first_user_as_admin:
-        db = get_db()
-        result = db.execute('SELECT count(id) as user_count FROM user').fetchone()
-        if result['user_count'] != 0:
-            current_app.config['CREATE_FIRST_USER_AS_ADMIN'] = False
+    # posts are paginated by keyset on (created, id), so the cost of a page
+    #   stays the same no matter how far back it is or how many posts exist
+    per_page = current_app.config.get('POSTS_PER_PAGE', 10)
+    before = parse_cursor(request.args.get('before'))
+    after = parse_cursor(request.args.get('after'))
+
+    # nothing is read or rendered if the client's copy of the page is current
+    response = not_modified(get_index_etag(per_page, before, after))
+    if response is not None:
+        return response
+
+    # the page can be streamed as each post is read, except when paging
+    #   towards newer posts, which are read oldest first, or when there are
+    #   flashed messages, since clearing them from the session has to happen
+    #   before the headers go out
+    if current_app.config['INDEX_STREAMING'] and after is None and not session.get('_flashes'):
+        pager = {'newer_cursor': None, 'older_cursor': None}
+        posts = stream_post_page(per_page, before, pager)
+        return add_validators(current_app.response_class(
+                stream_template('blog/index.html', posts=posts, pager=pager)
+                ))
 
+    new_posts, newer_cursor, older_cursor = get_post_page(per_page, before=before, after=after)
+    posts = [(post, get_board_url(post)) for post in new_posts]
+    pager = {'newer_cursor': newer_cursor, 'older_cursor': older_cursor}
+    return add_validators(render_template('blog/index.html', posts=posts, pager=pager))
+
+def get_board_url(post):
+    # the ending position's board is linked rather than inlined, so browsers
+    #   can cache it apart from the page and only load it once it's scrolled to
+    if post.game is None:
+        return None
+    # games uploaded before the summary columns existed have their summary read here,
+    #   until they are filled in by the refresh-game-data command
+    if post.game.final_fen is None:
+        for column, value in read_summary(get_file_contents(post.game.id)).items():
+            setattr(post.game, column, value)
+        # their final position isn't stored, so it can't be looked up by fen
+        return url_for('game.board_svg', game_id=post.game.id, ply=post.game.ply_count)
+    return url_for('game.fen_board_svg', fen=board_placement(post.game.final_fen))
+
+def stream_post_page(per_page, before, pager):
+    # yields each post on the page with its board url as it is read from the db,
+    #   newest first, so only one post is held at a time; the pager cursors
+    #   are filled in along the way, ready for the links after the posts
     db = get_db()
-    posts = db.execute(
-            'SELECT p.id, p.title, p.body, p.created, p.author_id, u.username, u.display_name, u.member_number, f.id as game_id, f.file_contents'
+    if before is not None:
+        cursor = db.execute(post_listing_query() +
+                ' WHERE (p.created, p.id) < (?, ?)'
+                ' ORDER BY p.created DESC, p.id DESC'
+                ' LIMIT ?',
+                (before[0], before[1], per_page+1)
+                )
+    else:
+        cursor = db.execute(post_listing_query() +
+                ' ORDER BY p.created DESC, p.id DESC'
+                ' LIMIT ?',
+                (per_page+1,)
+                )
+    last_post = None
+    count = 0
+    for row in cursor:
+        # the extra row only tells us there is an older page
+        if count == per_page:
+            pager['older_cursor'] = make_cursor(last_post)
+            break
+        post = Post.from_row(row)
+        if count == 0 and before is not None:
+            pager['newer_cursor'] = make_cursor(post)
+        yield post, get_board_url(post)
+        last_post = post
+        count += 1
+
+def get_index_etag(per_page, before, after):
+    # the post_version row is bumped by triggers on every change to posts,
+    #   files or authors' names, so one row lookup tells whether any page of
+    #   the listing may have changed
+    # there's no Last-Modified, since a delete changes the page without
+    #   leaving a newer timestamp behind
+    version = get_db().execute('SELECT version FROM post_version WHERE id = 1').fetchone()[0]
+    return page_etag('index', version, per_page, before, after)
+
+def parse_cursor(value):
+    # cursors are passed around as "<created>_<id>", where created is the
+    #   timestamp text exactly as it is stored in the db
+    if value is None:
+        return None
+    created, _, post_id = value.rpartition('_')
+    if created == '' or not post_id.isdigit():
+        abort(400, f"Invalid page cursor {value}")
+    return (created, int(post_id))
+
+def make_cursor(post):
+    return f"{post.created}_{post.id}"
+
+def post_listing_query():
+    return (f'SELECT {Post.listing_columns()}'
             ' FROM post p '
             ' JOIN user u ON (p.author_id = u.id)'
-            ' LEFT JOIN file f ON (p.id = f.post_id)'
-            ' ORDER BY p.created DESC'
-            ).fetchall()
-    new_posts = [dict(e) for e in posts]
-
-    # populate image and pgn data fields in posts, but only where an associated file exists
-    for post in new_posts:
-        if post['file_contents'] is None:
-            continue
-        pgn_data = chess.pgn.read_game(io.StringIO(str(post['file_contents'])))
-        # the parser is VERY loose, even if the file looks nothing like a PGN it will
-        #   still usually parse out at least one move of 1. --
-        # so we don't have to worry about read_game returning None here, since it
-        #   will only do that with an empty file and those are being filtered out upon
-        #   insertion to the db
-        post['svg_image'] = Markup(chess.svg.board(pgn_data.end().board(), size=350)) # pyright: ignore
-        post['pgn_data'] = Markup(pgn_data.accept(chess.pgn.StringExporter(columns=40, headers=False, variations=False))) # pyright: ignore
-        #post['pgn_event'] = pgn_data.headers['Event'] # pyright: ignore
-        #post['pgn_date'] = pgn_data.headers['Date'] # pyright: ignore
-        post['pgn_headers'] = pgn_data.headers # pyright: ignore
-
-    return render_template('blog/index.html', posts=new_posts)
+            # posts can have many games, the first one is shown on the index
+            ' LEFT JOIN file f ON (f.id = (SELECT min(id) FROM file WHERE post_id = p.id))'
+            ' LEFT JOIN game_content gc ON (f.content_id = gc.id)')
+
+def get_post_page(per_page, before=None, after=None):
+    query = post_listing_query()
+    db = get_db()
+    # fetch one extra row to find out whether there is another page after this one
+    if after is not None:
+        rows = db.execute(query +
+                ' WHERE (p.created, p.id) > (?, ?)'
+                ' ORDER BY p.created ASC, p.id ASC'
+                ' LIMIT ?',
+                (after[0], after[1], per_page+1)
+                ).fetchall()
+        has_newer = len(rows) > per_page
+        rows = list(reversed(rows[:per_page]))
+        has_older = True
+        # ran off the newest end of the list, so just show the first page instead
+        if not has_newer and len(rows) < per_page:
+            return get_post_page(per_page)
+    elif before is not None:
+        rows = db.execute(query +
+                ' WHERE (p.created, p.id) < (?, ?)'
+                ' ORDER BY p.created DESC, p.id DESC'
+                ' LIMIT ?',
+                (before[0], before[1], per_page+1)
+                ).fetchall()
+        has_newer = True
+        has_older = len(rows) > per_page
+        rows = rows[:per_page]
+    else:
+        rows = db.execute(query +
+                ' ORDER BY p.created DESC, p.id DESC'
+                ' LIMIT ?',
+                (per_page+1,)
+                ).fetchall()
+        has_newer = False
+        has_older = len(rows) > per_page
+        rows = rows[:per_page]
+
+    posts = [Post.from_row(e) for e in rows]
+    newer_cursor = make_cursor(posts[0]) if has_newer and len(posts) > 0 else None
+    older_cursor = make_cursor(posts[-1]) if has_older and len(posts) > 0 else None
+    return posts, newer_cursor, older_cursor
 
 @bp.route('/create', methods=('GET','POST'))
 @login_required
@@ -81,33 +192,45 @@ def create():
             error = 'Title is required'
 
         # first validate the pgn file, if one was included
-        if 'pgn_file' in request.files:
-            error = check_pgn_for_errors(request.files['pgn_file'])
+        pgn_file = request.files.get('pgn_file')
+        if error is None and pgn_file is not None:
+            error = check_pgn_for_errors(pgn_file)
 
-        if error is not None:
-            flash(error)
-        else:
-            # first make the post, so we can use the post id in saving the file
-            db = get_db()
-            cursor = db.execute('INSERT INTO post (title, body, author_id) VALUES (?, ?, ?)',
-                       (title, body, g.user['id'])
-                       )
-            db.commit()
-            # then insert the pgn data, if one exists (we know by now it's passed validation)
-            if 'pgn_file' in request.files:
-                post_id = cursor.lastrowid
-                file = request.files['pgn_file']
-                file_contents = file.stream.read()
-                file_name = secure_filename(str(file.filename))
-                db = get_db()
-                db.execute('INSERT INTO file (uploader_id, post_id, file_name, file_contents) VALUES (?, ?, ?, ?)',
-                           (g.user['id'], post_id, file_name, file_contents.decode("UTF-8"))
+        # the games are all parsed before the write starts, so the write lock
+        #   is only held (and a busy write only retried) for the inserts
+        games = None
+        if error is None and pgn_file is not None:
+            games, error = read_uploaded_games(pgn_file)
+
+        if error is None:
+            # the post and all of its games are saved in one transaction, so
+            #   nothing is left behind if the write fails partway
+            author_id = g.user.id
+            file_name = secure_filename(str(pgn_file.filename)) if pgn_file is not None else None
+            def save_post(db):
+                cursor = db.execute('INSERT INTO post (title, body, author_id) VALUES (?, ?, ?)',
+                           (title, body, author_id)
                            )
-                db.commit()
+                if games is not None:
+                    save_uploaded_games(db, author_id, cursor.lastrowid, file_name, games)
+            try:
+                run_write(save_post)
+            finally:
+                if games is not None:
+                    games.close()
             return redirect(url_for('blog.index'))
 
+        flash(error)
+
     return render_template('blog/create.html')
 
+def get_file_contents(file_id):
+    return decompress_pgn(get_db().execute(
+            'SELECT coalesce(f.file_contents, gc.file_contents) AS file_contents'
+            ' FROM file f JOIN game_content gc ON (f.content_id = gc.id) WHERE f.id = ?',
+            (file_id,)
+            ).fetchone()['file_contents'])
+
 def get_post(id, check_author=True):
     post = get_db().execute(
             'SELECT p.id, p.title, p.body, p.created, p.author_id, u.username'
@@ -119,7 +242,7 @@ def get_post(id, check_author=True):
     if post is None:
         abort(404, f"Post id {id} does not exist")
 
-    if check_author and post['author_id'] != g.user['id']:
+    if check_author and post['author_id'] != g.user.id:
         abort(403)
 
     return post
@@ -140,12 +263,10 @@ def update(id):
         if error is not None:
             flash(error)
         else:
-            db = get_db()
-            db.execute(
-                    'UPDATE post SET title = ?, body = ? WHERE id = ?',
+            run_write(lambda db: db.execute(
+                    'UPDATE post SET title = ?, body = ?, edited = current_timestamp WHERE id = ?',
                     (title, body, id)
-                    )
-            db.commit()
+                    ))
             return redirect(url_for('blog.index'))
 
     return render_template('blog/update.html', post=post)
@@ -154,9 +275,7 @@ def update(id):
 @login_required
 def delete(id):
     get_post(id)
-    db = get_db()
-    db.execute('DELETE FROM post WHERE id = ?', (id,))
-    db.commit()
+    run_write(lambda db: db.execute('DELETE FROM post WHERE id = ?', (id,)))
     return redirect(url_for('blog.index'))
 
 def check_pgn_for_errors(pgn: FileStorage):
@@ -165,24 +284,43 @@ def check_pgn_for_errors(pgn: FileStorage):
     if not pgn.filename or '.' not in pgn.filename or pgn.filename.rsplit('.',1)[1].lower() not in current_app.config['ALLOWED_FILETYPES']:
         return "Invalid PGN: file extension invalid, must be .pgn or .txt"
     # file must contain data
-    pgn_contents = pgn.stream.read()
-    if pgn_contents == b'':
+    if pgn.stream.read(1) == b'':
         return "Invalid PGN: empty file"
-    else:
-        # rewind the stream buffer so it can be read from again later
-        pgn.stream.seek(0)
-    # file must successfully parse as PGN
-    pgn_stringio = io.StringIO(str(pgn_contents))
-    game_tree = chess.pgn.read_game(pgn_stringio)
-    # the only way game_tree.game can return None is if the input StringIO
-    #   is empty, but we are already checking for empty file contents before this
-    game = game_tree.game() # pyright: ignore
-    if len(game.errors) > 0:
-        return f"Invalid PGN: errors encountered while parsing: {str(game.errors)}"
-    # the parser is VERY loose, even if the file looks nothing like a PGN it will
-    #   still usually parse out at least one move of 1. --
-    first_move = game.next()
-    if first_move is None or str(first_move)[:5] == '1. --':
-        return f"Invalid PGN, unable to parse first move: {str(pgn_contents)}"
+    # rewind the stream buffer so it can be read from again later
+    pgn.stream.seek(0)
     # all validations passed
     return None
+
+def read_uploaded_games(pgn: FileStorage):
+    # uploads can hold any number of games; werkzeug spools large uploads to a
+    #   temp file, which is read back one game at a time, and each game is
+    #   staged as the data derived from it for saving
+    # returns the staged games, or None and an error message if any game is
+    #   invalid
+    # utf-8-sig drops the byte order mark some editors start files with
+    text_stream = io.TextIOWrapper(pgn.stream, encoding='utf-8-sig')
+    games = StagedGames()
+    error = None
+    try:
+        for ingested in ingest_pgn(text_stream):
+            if ingested.error is not None:
+                error = ingested.error if len(games) == 0 else f'Game {len(games)+1}: {ingested.error}'
+                break
+            # derive everything listings need from the game now, once, so the
+            #   index never has to parse the PGN again
+            games.append(derive_game_data(ingested))
+    except UnicodeDecodeError:
+        error = "Invalid PGN: file must be UTF-8 text"
+    finally:
+        # leave the underlying stream open for werkzeug to clean up
+        text_stream.detach()
+    if error is None and len(games) == 0:
+        error = "Invalid PGN, unable to parse first move: no moves found"
+    if error is not None:
+        games.close()
+        return None, error
+    return games, None
+
+def save_uploaded_games(db, uploader_id, post_id, file_name, games):
+    for number, game_data in enumerate(games, start=1):
+        save_game_file(db, uploader_id, post_id, file_name if number == 1 else f'{file_name}#{number}', game_data)
@@ -0,0 +1,99 @@
+#Doublecheck - A web-based chess game database.
+#Copyright (C) 2024 Nick Edner
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU Affero General Public License as published
+#by the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU Affero General Public License for more details.
+
+#You should have received a copy of the GNU Affero General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from flask import current_app
+
+from doublecheck.cache import LRUCache
+
+import chess, chess.svg
+import hashlib
+import os
+import tempfile
+
+class BoardCache(object):
+    """Rendered board SVGs keyed by (fen, size, orientation, lastmove), held in
+    an in-process LRU in front of an optional directory of rendered files."""
+
+    def __init__(self, maxsize, directory=None):
+        self.memory = LRUCache(maxsize)
+        self.directory = directory
+        self.disk_hits = 0
+        self.disk_misses = 0
+        # the directory is only created once the first board is written to it
+
+    def render(self, fen, size=350, orientation=chess.WHITE, lastmove=None):
+        if isinstance(lastmove, chess.Move):
+            lastmove = lastmove.uci()
+        key = (fen, size, bool(orientation), lastmove)
+        svg = self.memory.get(key)
+        if svg is not None:
+            return svg
+
+        path = self._path(key)
+        if path is not None and os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                svg = f.read()
+            self.disk_hits += 1
+        else:
+            svg = chess.svg.board(
+                    chess.Board(fen),
+                    size=size,
+                    orientation=bool(orientation),
+                    lastmove=chess.Move.from_uci(lastmove) if lastmove else None
+                    )
+            if path is not None:
+                self.disk_misses += 1
+                self._write(path, svg)
+        self.memory.put(key, svg)
+        return svg
+
+    def stats(self):
+        stats = self.memory.stats()
+        stats['disk_hits'] = self.disk_hits
+        stats['disk_misses'] = self.disk_misses
+        return stats
+
+    def _path(self, key):
+        if self.directory is None:
+            return None
+        digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, digest[:2], f'{digest}.svg')
+
+    def _write(self, path, svg):
+        # write to a temp file and move it into place, so another worker
+        #   never reads a half-written render
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(svg)
+        os.replace(tmp_path, path)
+
+def get_board_cache():
+    return current_app.extensions['board_cache']
+
+def board_placement(fen):
+    # boards only show where the pieces are, so the rest of the fen is left
+    #   out of board urls and cache keys, letting every position with the
+    #   same pieces share one image
+    placement = fen.split(' ', 1)[0]
+    # raises ValueError if it isn't a valid board
+    chess.BaseBoard(placement)
+    return placement
+
+def init_app(app):
+    app.extensions['board_cache'] = BoardCache(
+            app.config['BOARD_CACHE_SIZE'],
+            directory=app.config['BOARD_CACHE_DIR']
+            )
@@ -0,0 +1,59 @@
+#Doublecheck - A web-based chess game database.
+#Copyright (C) 2024 Nick Edner
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU Affero General Public License as published
+#by the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU Affero General Public License for more details.
+
+#You should have received a copy of the GNU Affero General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from flask import current_app, g, make_response, request, session
+from werkzeug.http import is_resource_modified
+
+from doublecheck.settings import get_settings
+
+import hashlib
+
+# Pages are given an ETag made from everything they show which can change,
+#   so a reload of an unchanged page gets a 304 before any of it is built.
+
+def page_etag(*parts):
+    # every page also depends on who is looking at it (the nav links and edit
+    #   buttons) and on the runtime settings (the register link)
+    user = g.get('user')
+    parts += (None if user is None else (user.id, user.role), get_settings().version)
+    return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+def not_modified(etag, last_modified=None):
+    """Returns a 304 response if the client's copy of the page is current,
+    otherwise None, and the page is built as usual and passed through
+    add_validators. Pages with flashed messages waiting are always built
+    and never validated, since showing the messages clears them."""
+    if request.method not in ('GET', 'HEAD') or session.get('_flashes'):
+        return None
+    g.page_validators = (etag, last_modified)
+    if is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        return None
+    return add_validators(current_app.response_class(status=304))
+
+def add_validators(response):
+    response = make_response(response)
+    validators = g.pop('page_validators', None)
+    if validators is None:
+        return response
+    etag, last_modified = validators
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    # the page is different for each user, so only the browser may keep it,
+    #   and it has to check back each time
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    response.vary.add('Cookie')
+    return response
@@ -13,26 +13,177 @@
 
 #You should have received a copy of the GNU Affero General Public License
 #along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import concurrent.futures
+import itertools
+import os
+import re
 import sqlite3
+import threading
+import time
+import urllib.parse
 
 import click
-from flask import current_app, g
+from flask import current_app, g, has_request_context, request
+from flask.cli import with_appcontext
+from werkzeug.utils import secure_filename
 
-def get_db():
-    if 'db' not in g:
-        g.db = sqlite3.connect(
-                current_app.config['DATABASE'],
-                detect_types=sqlite3.PARSE_DECLTYPES
-                )
-        g.db.row_factory = sqlite3.Row
+from doublecheck.pgn import (
+        SUMMARY_COLUMNS, compress_pgn, decompress_pgn, encode_moves, game_hash, iter_pgn_chunks, parse_game_chunk,
+        read_game, save_game_file, summarize_game, summary_values
+        )
+from doublecheck.querylog import TimedConnection, get_query_log
 
-    return g.db
+def connect(database, pragmas, readonly=False, query_log=None):
+    # with a query log, every statement on the connection gets timed
+    factory = sqlite3.Connection if query_log is None else TimedConnection
+    if readonly:
+        # read-only connections can never take the write lock, so under WAL
+        #   they never wait on (or hold up) the writer
+        uri = f'file:{urllib.parse.quote(os.path.abspath(database))}?mode=ro'
+        db = sqlite3.connect(uri, detect_types=sqlite3.PARSE_DECLTYPES, uri=True, factory=factory)
+    else:
+        db = sqlite3.connect(database, detect_types=sqlite3.PARSE_DECLTYPES, factory=factory)
+    if query_log is not None:
+        db.query_log = query_log # pyright: ignore
+    db.row_factory = sqlite3.Row
+    for name, value in pragmas.items():
+        # the journal mode is a property of the db file, only the writer sets it
+        if readonly and name == 'journal_mode':
+            continue
+        db.execute(f'PRAGMA {name} = {value}')
+    return db
+
+class ConnectionPool(object):
+    """Keeps an open writer and read-only connection per thread, so a request
+    doesn't have to connect (and apply pragmas) before its first query."""
+
+    def __init__(self, database, pragmas, query_log=None):
+        self.database = database
+        self.pragmas = pragmas
+        self.query_log = query_log
+        self._local = threading.local()
+
+    def _key(self, readonly):
+        return 'read_db' if readonly else 'db'
+
+    def checkout(self, readonly=False):
+        key = self._key(readonly)
+        db = getattr(self._local, key, None)
+        if db is not None:
+            # make sure the connection still works before handing it out
+            try:
+                db.execute('SELECT 1').fetchone()
+            except sqlite3.Error:
+                self.discard(db)
+                db = None
+        if db is None:
+            db = connect(self.database, self.pragmas, readonly=readonly, query_log=self.query_log)
+            setattr(self._local, key, db)
+        return db
+
+    def checkin(self, db):
+        # whatever the request left uncommitted doesn't carry over to the next one
+        try:
+            if db.in_transaction:
+                db.rollback()
+        except sqlite3.Error:
+            self.discard(db)
+
+    def discard(self, db):
+        for key in (self._key(True), self._key(False)):
+            if getattr(self._local, key, None) is db:
+                setattr(self._local, key, None)
+        try:
+            db.close()
+        except sqlite3.Error:
+            pass
+
+def get_pool():
+    pool = current_app.extensions.get('db_pool')
+    if pool is None:
+        pool = ConnectionPool(current_app.config['DATABASE'], current_app.config['SQLITE_PRAGMAS'], get_query_log())
+        current_app.extensions['db_pool'] = pool
+    return pool
+
+def get_db(write=None):
+    # GET and HEAD requests get a read-only connection, unless they ask to write;
+    #   everything else (other requests, cli commands, tests) gets the writer
+    if write is None:
+        write = not (has_request_context() and request.method in ('GET', 'HEAD'))
+    key = 'db' if write else 'read_db'
+    if key not in g:
+        if current_app.config['DATABASE_PERSISTENT_CONNECTIONS']:
+            db = get_pool().checkout(readonly=not write)
+        else:
+            db = connect(current_app.config['DATABASE'], current_app.config['SQLITE_PRAGMAS'], readonly=not write,
+                         query_log=get_query_log())
+        setattr(g, key, db)
+
+    return g.get(key)
 
 def close_db(e=None):
-    db = g.pop('db', None)
+    for key in ('db', 'read_db'):
+        db = g.pop(key, None)
+
+        if db is not None:
+            if current_app.config['DATABASE_PERSISTENT_CONNECTIONS']:
+                get_pool().checkin(db)
+            else:
+                db.close()
+
+def is_busy(e):
+    # sqlite_errorcode is only there from python 3.11, older versions just
+    #   have the message to go on
+    code = getattr(e, 'sqlite_errorcode', None)
+    if code is not None:
+        return code & 0xff in (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED)
+    return 'locked' in str(e) or 'busy' in str(e)
 
-    if db is not None:
-        db.close()
+def _run_write(fn, retries, backoff):
+    db = get_db(write=True)
+    attempt = 0
+    while True:
+        try:
+            # take the write lock up front, so the transaction can't fail
+            #   halfway through when another connection gets there first
+            if not db.in_transaction:
+                db.execute('BEGIN IMMEDIATE')
+            result = fn(db)
+            db.commit()
+            return result
+        except sqlite3.OperationalError as e:
+            db.rollback()
+            if not is_busy(e) or attempt >= retries:
+                raise
+        except BaseException:
+            db.rollback()
+            raise
+        # back off a little longer each time, up to a second
+        time.sleep(min(backoff * 2 ** attempt, 1.0))
+        attempt += 1
+
+def _run_write_in_context(app, fn, retries, backoff):
+    with app.app_context():
+        return _run_write(fn, retries, backoff)
+
+def run_write(fn):
+    """Run fn(db) in a single write transaction, retrying it if the database
+    is locked. Anything fn raises rolls the whole transaction back.
+
+    With DATABASE_WRITER_THREAD set, writes are queued up and run one at a
+    time by a single writer thread, instead of each request fighting over the
+    lock."""
+    retries = current_app.config['DATABASE_WRITE_RETRIES']
+    backoff = current_app.config['DATABASE_WRITE_BACKOFF']
+    if not current_app.config['DATABASE_WRITER_THREAD']:
+        return _run_write(fn, retries, backoff)
+
+    writer = current_app.extensions.get('db_writer')
+    if writer is None:
+        writer = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-writer')
+        current_app.extensions['db_writer'] = writer
+    app = current_app._get_current_object() # pyright: ignore
+    return writer.submit(_run_write_in_context, app, fn, retries, backoff).result()
 
 def init_db():
     db = get_db()
@@ -46,6 +197,280 @@ def init_db_command():
     init_db()
     click.echo('Initialized the database.')
 
+# the tables, indexes and triggers schema.sql creates, and the rows it seeds
+SCHEMA_STATEMENT = re.compile(r'^(CREATE (?:TABLE|INDEX|TRIGGER)|INSERT INTO|DROP TABLE IF EXISTS) (\w+)', re.MULTILINE)
+
+def schema_statements(script):
+    statement = ''
+    for line in script.splitlines(keepends=True):
+        statement += line
+        # triggers have ; inside them, so this waits for the whole statement
+        if sqlite3.complete_statement(statement):
+            yield statement
+            statement = ''
+
+def migrate_db(batch_size=500):
+    """Bring a database created by an older version up to date, without
+    touching its data: whatever tables, indexes and triggers schema.sql has
+    which the database doesn't are created, and games stored in the file
+    table itself are moved into game_content. Returns how many were moved.
+
+    Moved games keep their text as it was stored, and get their derived
+    data from refresh-game-data and compression from compress-files."""
+    with current_app.open_resource('schema.sql') as f:
+        schema = f.read().decode('utf8')
+
+    def migrate(db):
+        # file gets a new shape, so the old table is set aside to copy from
+        file_columns = {e['name'] for e in db.execute('PRAGMA table_info(file)')}
+        move_files = 'content_id' not in file_columns
+        if move_files:
+            db.execute('ALTER TABLE file RENAME TO file_old')
+
+        existing = {e['name'] for e in db.execute('SELECT name FROM sqlite_master')}
+        created = set()
+        for statement in schema_statements(schema):
+            match = SCHEMA_STATEMENT.search(statement)
+            if match is None:
+                continue
+            kind, name = match.groups()
+            if kind.startswith('CREATE') and name not in existing:
+                db.execute(statement)
+                created.add(name)
+            # rows are only seeded into tables which were just created
+            elif kind == 'INSERT INTO' and name in created:
+                db.execute(statement)
+
+        if not move_files:
+            return 0
+        moved = 0
+        last_id = 0
+        while True:
+            files = db.execute('SELECT id, file_contents FROM file_old WHERE id > ? ORDER BY id LIMIT ?',
+                               (last_id, batch_size)).fetchall()
+            if len(files) == 0:
+                break
+            for file in files:
+                # copies of the same game share one game_content row, and
+                #   files which differ from it (e.g. in their annotations)
+                #   keep their own text, the same as uploads do
+                text = decompress_pgn(file['file_contents'])
+                content_hash = game_hash(read_game(text))
+                db.execute('INSERT OR IGNORE INTO game_content (content_hash, file_contents) VALUES (?, ?)',
+                           (content_hash, file['file_contents']))
+                content = db.execute('SELECT id, file_contents FROM game_content WHERE content_hash = ?',
+                                     (content_hash,)).fetchone()
+                own_text = None if decompress_pgn(content['file_contents']) == text else file['file_contents']
+                db.execute('INSERT INTO file (id, uploader_id, post_id, created, file_name, content_id, file_contents)'
+                           ' SELECT id, uploader_id, post_id, created, file_name, ?, ? FROM file_old WHERE id = ?',
+                           (content['id'], own_text, file['id']))
+            moved += len(files)
+            last_id = files[-1]['id']
+        db.execute('DROP TABLE file_old')
+        return moved
+
+    return run_write(migrate)
+
+@click.command('migrate-db')
+@with_appcontext
+def migrate_db_command():
+    """Update the tables of an existing database, keeping its data."""
+    moved = migrate_db()
+    click.echo('Migrated the database.')
+    if moved > 0:
+        click.echo(f'Moved {moved} game file(s), run refresh-game-data and compress-files to finish.')
+
+def refresh_game_data():
+    db = get_db()
+    contents = db.execute(
+            'SELECT gc.id, gc.file_contents'
+            ' FROM game_content gc'
+            ' WHERE gc.final_fen IS NULL'
+            '  OR gc.moves IS NULL'
+            ).fetchall()
+    for content in contents:
+        game = read_game(decompress_pgn(content['file_contents']))
+        summary = summarize_game(game)
+        db.execute(f'UPDATE game_content SET start_fen = ?, moves = ?, {", ".join(e + " = ?" for e in SUMMARY_COLUMNS)} WHERE id = ?',
+                   (game.headers.get('FEN'), encode_moves(game.mainline_moves())) + summary_values(summary) + (content['id'],)
+                   )
+    db.commit()
+    return len(contents)
+
+@click.command('refresh-game-data')
+@with_appcontext
+def refresh_game_data_command():
+    """Fill in derived game data for files uploaded before it was stored."""
+    count = refresh_game_data()
+    click.echo(f'Refreshed game data for {count} file(s).')
+
+def compress_files(batch_size=500):
+    # compresses files stored before compression was added, a batch at a time
+    #   so a large table doesn't have to fit in memory; files with their own
+    #   text keep it in the file table
+    db = get_db()
+    count = 0
+    for table in ('game_content', 'file'):
+        while True:
+            files = db.execute(
+                    f"SELECT id, file_contents FROM {table} WHERE typeof(file_contents) = 'text' LIMIT ?",
+                    (batch_size,)
+                    ).fetchall()
+            if len(files) == 0:
+                break
+            db.executemany(f'UPDATE {table} SET file_contents = ? WHERE id = ?',
+                           [(compress_pgn(e['file_contents']), e['id']) for e in files]
+                           )
+            db.commit()
+            count += len(files)
+    return count
+
+@click.command('compress-files')
+@with_appcontext
+def compress_files_command():
+    """Compress game files stored as plain text."""
+    count = compress_files()
+    click.echo(f'Compressed {count} file(s).')
+
+def dedupe_games(batch_size=500):
+    # rehashes every stored game, and merges any which turn out to be the same
+    #   game into the oldest copy (e.g. games stored before hashing existed,
+    #   or after the hash changes); files whose text differs from the copy
+    #   they're merged into keep their own
+    db = get_db()
+    last_id = 0
+    merged = 0
+    while True:
+        contents = db.execute(
+                'SELECT id, content_hash, file_contents FROM game_content WHERE id > ? ORDER BY id LIMIT ?',
+                (last_id, batch_size)
+                ).fetchall()
+        if len(contents) == 0:
+            return merged
+        for content in contents:
+            text = decompress_pgn(content['file_contents'])
+            content_hash = game_hash(read_game(text))
+            if content_hash == content['content_hash']:
+                continue
+            existing = db.execute('SELECT id, file_contents FROM game_content WHERE content_hash = ?', (content_hash,)).fetchone()
+            if existing is None:
+                db.execute('UPDATE game_content SET content_hash = ? WHERE id = ?', (content_hash, content['id']))
+                continue
+            if decompress_pgn(existing['file_contents']) != text:
+                db.execute('UPDATE file SET file_contents = ? WHERE content_id = ? AND file_contents IS NULL',
+                           (content['file_contents'], content['id']))
+            db.execute('UPDATE file SET content_id = ? WHERE content_id = ?', (existing['id'], content['id']))
+            db.execute('DELETE FROM game_content WHERE id = ?', (content['id'],))
+            merged += 1
+        db.commit()
+        last_id = contents[-1]['id']
+
+@click.command('dedupe-games')
+@with_appcontext
+def dedupe_games_command():
+    """Merge stored copies of the same game."""
+    merged = dedupe_games()
+    click.echo(f'Merged {merged} duplicate game(s).')
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if len(batch) == 0:
+            return
+        yield batch
+
+def import_pgn(path, author_id, batch_size=500, workers=None, restart=False, progress=None):
+    """Import every game in a pgn file as its own post. Progress is saved with
+    each batch, so an interrupted import picks up where it left off."""
+    db = get_db()
+    source = os.path.abspath(path)
+    file_name = secure_filename(os.path.basename(path))
+    if restart:
+        db.execute('DELETE FROM pgn_import WHERE source = ?', (source,))
+        db.commit()
+    state = db.execute('SELECT games_read, games_imported FROM pgn_import WHERE source = ?', (source,)).fetchone()
+    games_read, games_imported = (state['games_read'], state['games_imported']) if state is not None else (0, 0)
+    # reported once before anything is read, so a resumed import's progress
+    #   can be told apart from what earlier runs did
+    if progress is not None:
+        progress(games_read, games_imported)
+
+    def save_batch(batch_results):
+        nonlocal games_read, games_imported
+        for result in batch_results:
+            games_read += 1
+            if result is None:
+                continue
+            summary = result.summary
+            title = f"{summary['pgn_white']} vs {summary['pgn_black']}, {summary['pgn_event']}"
+            cursor = db.execute('INSERT INTO post (title, body, author_id) VALUES (?, ?, ?)', (title, '', author_id))
+            save_game_file(db, author_id, cursor.lastrowid, f'{file_name}#{games_read}', result)
+            games_imported += 1
+        db.execute('INSERT OR REPLACE INTO pgn_import (source, games_read, games_imported, updated) VALUES (?, ?, ?, current_timestamp)',
+                   (source, games_read, games_imported)
+                   )
+        # the whole batch and the progress marker go in one transaction
+        db.commit()
+        if progress is not None:
+            progress(games_read, games_imported)
+
+    with open(path, encoding='utf-8-sig', errors='replace') as f:
+        chunks = itertools.islice(iter_pgn_chunks(f), games_read, None)
+        if workers == 0:
+            for batch in batched(chunks, batch_size):
+                save_batch([parse_game_chunk(e) for e in batch])
+        else:
+            workers = workers or os.cpu_count() or 1
+            with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+                # parse the next batch in the pool while the last one is being saved
+                in_flight = None
+                for batch in batched(chunks, batch_size):
+                    results = pool.map(parse_game_chunk, batch, chunksize=max(1, batch_size // (workers * 4)))
+                    if in_flight is not None:
+                        save_batch(in_flight)
+                    in_flight = results
+                if in_flight is not None:
+                    save_batch(in_flight)
+
+    return games_read, games_imported
+
+@click.command('import-pgn')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--author', required=True, help='Username to post the imported games as.')
+@click.option('--batch-size', default=500, show_default=True, help='Games saved per transaction.')
+@click.option('--workers', type=int, default=None, help='Parser processes, 0 to parse in this process. Defaults to the cpu count.')
+@click.option('--restart', is_flag=True, help='Ignore saved progress and import from the first game.')
+@with_appcontext
+def import_pgn_command(path, author, batch_size, workers, restart):
+    """Import every game in a (possibly very large) pgn file."""
+    user = get_db().execute('SELECT id FROM user WHERE username = ?', (author,)).fetchone()
+    if user is None:
+        raise click.BadParameter(f'User {author} does not exist', param_hint='--author')
+
+    started = time.monotonic()
+    first_read = None
+
+    def progress(games_read, games_imported):
+        nonlocal first_read
+        # the first call comes before this run has read anything
+        if first_read is None:
+            first_read = games_read
+            if games_read > 0:
+                click.echo(f'Resuming after {games_read} games')
+            return
+        elapsed = time.monotonic() - started
+        rate = (games_read - first_read) / elapsed if elapsed > 0 else 0
+        click.echo(f'{games_read} games read, {games_imported} imported ({rate:.1f} games/s)')
+
+    games_read, games_imported = import_pgn(path, user['id'], batch_size=batch_size, workers=workers, restart=restart, progress=progress)
+    click.echo(f'Imported {games_imported} of {games_read} games from {path}.')
+
 def init_app(app):
     app.teardown_appcontext(close_db)
     app.cli.add_command(init_db_command)
+    app.cli.add_command(migrate_db_command)
+    app.cli.add_command(refresh_game_data_command)
+    app.cli.add_command(import_pgn_command)
+    app.cli.add_command(compress_files_command)
+    app.cli.add_command(dedupe_games_command)
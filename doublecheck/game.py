@@ -14,15 +14,20 @@
 #You should have received a copy of the GNU Affero General Public License
 #along with this program.  If not, see <https://www.gnu.org/licenses/>.
 from flask import (
-        Blueprint, app, current_app, flash, g, redirect, render_template, request, session, url_for
+        Blueprint, app, current_app, flash, g, jsonify, redirect, render_template, request, session, url_for
         )
-from markupsafe import Markup
 from werkzeug.exceptions import abort
 
-from doublecheck.db import get_db
+from doublecheck.boards import board_placement, get_board_cache
+from doublecheck.cache import LRUCache
+from doublecheck.conditional import add_validators, not_modified, page_etag
+from doublecheck.db import get_db, run_write
+from doublecheck.pgn import (
+        SUMMARY_COLUMNS, SUMMARY_HEADERS, decompress_pgn, encode_moves, has_annotations, read_game, read_header_summary,
+        replay_positions
+        )
 
-import chess.pgn, chess.svg
-import io
+import datetime
 
 bp = Blueprint('game', __name__, url_prefix='/game')
 
@@ -32,7 +37,11 @@ def index():
 
 def get_file_by_id(id):
     file = get_db().execute(
-            'SELECT f.* from file f'
+            'SELECT f.id, f.post_id, f.file_name, f.content_id,'
+            ' coalesce(f.file_contents, gc.file_contents) AS file_contents, gc.start_fen, gc.moves'
+            + ''.join(f', gc.{e}' for e in SUMMARY_COLUMNS) +
+            ' from file f'
+            ' join game_content gc on (f.content_id = gc.id)'
             ' where f.id = ?',
             (id,)
             ).fetchone()
@@ -42,37 +51,170 @@ def get_file_by_id(id):
 
     return file
 
+def get_game_view_data(id):
+    # each game's headers and mainline positions are cached per worker by
+    #   file id, so moving through a game is just a lookup by ply
+    game_cache = current_app.extensions['game_cache']
+    view_data = game_cache.get(id)
+    if view_data is not None:
+        return view_data
+
+    file = get_file_by_id(id)
+    summary = {e: file[e] for e in SUMMARY_COLUMNS}
+    # only the headers are shown, so games without a stored summary just have
+    #   their headers read
+    if file['final_fen'] is None:
+        summary = read_header_summary(decompress_pgn(file['file_contents']))
+    db = get_db()
+    # the positions are replayed from the encoded moves; games uploaded before
+    #   the moves were stored get them saved on first view
+    start_fen, moves = file['start_fen'], file['moves']
+    if moves is None:
+        game = read_game(decompress_pgn(file['file_contents']))
+        start_fen, moves = game.headers.get('FEN'), encode_moves(game.mainline_moves())
+        # this is a write, even when viewing the game with a GET
+        run_write(lambda db: db.execute('UPDATE game_content SET start_fen = ?, moves = ? WHERE id = ? AND moves IS NULL',
+                                        (start_fen, moves, file['content_id'])))
+    positions = replay_positions(start_fen, moves)
+
+    # games uploaded together in one post link to each other
+    prev_game = db.execute('SELECT max(id) FROM file WHERE post_id = ? AND id < ?', (file['post_id'], id)).fetchone()
+    next_game = db.execute('SELECT min(id) FROM file WHERE post_id = ? AND id > ?', (file['post_id'], id)).fetchone()
+
+    view_data = {
+            'headers': {e: summary[f'pgn_{e.lower()}'] for e in SUMMARY_HEADERS},
+            'positions': positions,
+            'prev_game_id': prev_game[0],
+            'next_game_id': next_game[0],
+            }
+    game_cache.put(id, view_data)
+    return view_data
+
+def get_annotated_mainline(id, view_data):
+    # the positions are replayed from the encoded moves, but the move list
+    #   shows the game as uploaded, with its comments, NAGs and variations, so
+    #   the page needs the parsed game too; it is parsed on the first view and
+    #   kept with the rest of the view data, as positions.json and board
+    #   images never need it; whether it has any annotations is kept with it,
+    #   since finding out means exporting the whole game
+    mainline = view_data.get('mainline')
+    if mainline is None:
+        file = get_db().execute(
+                'SELECT coalesce(f.file_contents, gc.file_contents) AS file_contents'
+                ' FROM file f JOIN game_content gc ON (f.content_id = gc.id) WHERE f.id = ?',
+                (id,)
+                ).fetchone()
+        game = read_game(decompress_pgn(file['file_contents']))
+        mainline = [game] + list(game.mainline())
+        view_data['annotated'] = has_annotations(game)
+        view_data['mainline'] = mainline
+    return mainline
+
 @bp.route('/<int:game_id>/view', methods=('GET','POST'))
 def view(game_id):
+    # only the game id and current ply are kept in the session, the game
+    #   itself comes from the game cache
     session_game_view_id = session.get('game_view_id')
     if session_game_view_id is None or session_game_view_id != game_id:
-        file = get_file_by_id(game_id)
-        session['game_view_file_contents'] = str(file['file_contents'])
         session['game_view_id'] = game_id
         session['game_view_ply'] = 0
 
-    # we don't have to worry about read_game returning None here, since it
-    #   will only do that with an empty file and those are being filtered
-    #   out upon insertion to the db
-    # so, we can ignore pyright warning us about it possibly being None
-    game = chess.pgn.read_game(io.StringIO(session.get('game_view_file_contents')))
-    game_ply = session.get('game_view_ply',0)
+    # a stored game never changes, so the page only depends on which game and
+    #   ply are shown; nothing is read or rendered if the client has it already
+    if request.method == 'GET':
+        file = get_db().execute('SELECT created FROM file WHERE id = ?', (game_id,)).fetchone()
+        if file is None:
+            abort(404, f"File with game id {game_id} does not exist")
+        etag = page_etag('game', game_id, session.get('game_view_ply', 0),
+                         current_app.config['GAME_VIEW_CLIENT_STEPPING'])
+        response = not_modified(etag, file['created'].replace(tzinfo=datetime.timezone.utc))
+        if response is not None:
+            return response
 
-    if game_ply > 0:
-        for _ in range(game_ply, 0, -1):
-            game = game.next() # pyright: ignore
+    view_data = get_game_view_data(game_id)
+    positions = view_data['positions']
+    last_ply = len(positions) - 1
+    game_ply = min(session.get('game_view_ply', 0), last_ply)
 
     if request.method == 'POST':
-        if request.form.get('nextMove') is not None and not game.is_end(): # pyright: ignore
-            game = game.next() # pyright: ignore
+        if request.form.get('nextMove') is not None and game_ply < last_ply:
+            game_ply += 1
         elif request.form.get('prevMove') is not None and game_ply > 0:
-            game = game.parent # pyright: ignore
-        elif request.form.get('firstMove') is not None and game_ply > 0:
-            game = game.game() # pyright: ignore
-        elif request.form.get('lastMove') is not None and not game.is_end(): # pyright: ignore
-            game = game.end() # pyright: ignore
-        session['game_view_ply'] = game.ply() # pyright: ignore
+            game_ply -= 1
+        elif request.form.get('firstMove') is not None:
+            game_ply = 0
+        elif request.form.get('lastMove') is not None:
+            game_ply = last_ply
+        elif request.form.get('ply', '').isdigit():
+            game_ply = min(int(request.form['ply']), last_ply)
+        session['game_view_ply'] = game_ply
+
+    position = positions[game_ply]
+    mainline = get_annotated_mainline(game_id, view_data)
+    # the starting position shows the whole game, headers included, and later
+    #   ones the game from the move just played
+    movetext = str(mainline[game_ply])
+    # client side stepping only knows the bare moves, so annotated games are
+    #   stepped through on the server to keep their annotations on the page
+    client_stepping = current_app.config['GAME_VIEW_CLIENT_STEPPING'] and not view_data['annotated']
+
+    return add_validators(render_template('game/view.html', headers=view_data['headers'], position=position,
+                                          is_end=game_ply == last_ply, movetext=movetext, client_stepping=client_stepping,
+                                          prev_game_id=view_data['prev_game_id'], next_game_id=view_data['next_game_id']))
+
+@bp.route('/<int:game_id>/positions.json')
+def positions_json(game_id):
+    # everything needed to step through a game in the browser, in one response
+    #   which can be cached since a stored game never changes
+    view_data = get_game_view_data(game_id)
+    response = jsonify({
+            'id': game_id,
+            'headers': view_data['headers'],
+            'positions': [e._asdict() for e in view_data['positions']],
+            })
+    response.cache_control.public = True
+    response.cache_control.max_age = current_app.config['GAME_POSITIONS_MAX_AGE']
+    response.add_etag()
+    return response.make_conditional(request)
+
+@bp.route('/<int:game_id>/board/<int:ply>.svg')
+def board_svg(game_id, ply):
+    positions = get_game_view_data(game_id)['positions']
+    if ply >= len(positions):
+        abort(404, f"Game {game_id} has no ply {ply}")
+    return board_response(positions[ply].fen)
+
+@bp.route('/board/<path:fen>.svg')
+def fen_board_svg(fen):
+    # addressed by the board part of a fen, for listings which only know a
+    #   game's final position; only the final positions of stored games are
+    #   served, so made up fens can't fill up the board cache
+    try:
+        placement = board_placement(fen)
+    except ValueError:
+        abort(404, f"Invalid board {fen}")
+    if not is_final_position(placement):
+        abort(404, f"No game ends with board {placement}")
+    return board_response(placement)
+
+def is_final_position(placement):
+    # final_fen starts with the placement then a space, and '!' sorts right
+    #   after the space, so this is a range over the final_fen index
+    return get_db().execute(
+            'SELECT 1 FROM game_content WHERE final_fen > ? AND final_fen < ? LIMIT 1',
+            (placement + ' ', placement + '!')
+            ).fetchone() is not None
 
-    game_image = Markup(chess.svg.board(game.board(), size=350)) # pyright: ignore
+def board_response(fen):
+    # the board at a url never changes (file ids aren't reused), so browsers
+    #   and the proxy in front can keep it without ever checking back
+    svg = get_board_cache().render(board_placement(fen), size=350)
+    response = current_app.response_class(svg, mimetype='image/svg+xml')
+    response.cache_control.public = True
+    response.cache_control.max_age = current_app.config['BOARD_IMAGE_MAX_AGE']
+    response.cache_control.immutable = True
+    response.add_etag()
+    return response.make_conditional(request)
 
-    return render_template('game/view.html', game=game, game_image=game_image)
+def init_app(app):
+    app.extensions['game_cache'] = LRUCache(app.config['GAME_CACHE_SIZE'])
@@ -0,0 +1,121 @@
+#Doublecheck - A web-based chess game database.
+#Copyright (C) 2024 Nick Edner
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU Affero General Public License as published
+#by the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU Affero General Public License for more details.
+
+#You should have received a copy of the GNU Affero General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from dataclasses import dataclass
+from typing import Optional
+
+import datetime
+
+from doublecheck.pgn import SUMMARY_COLUMNS
+
+# Each model lists the columns it is built from, in field order, so a query
+#   selecting exactly COLUMNS can build it straight from the row. They use
+#   __slots__ rather than a __dict__ per instance, which keeps long listings
+#   small and quick to build.
+
+class Model(object):
+    __slots__ = ()
+    COLUMNS = ()
+
+    @classmethod
+    def columns(cls, alias=None):
+        prefix = '' if alias is None else f'{alias}.'
+        return ', '.join(prefix + e for e in cls.COLUMNS)
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(*row)
+
+    # lets code (and templates) written against sqlite3.Row keep using
+    #   model['column']
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+@dataclass
+class User(Model):
+    __slots__ = ('id', 'username', 'role', 'display_name', 'member_number', 'timezone',
+                 'created', 'last_login', 'active', 'deactivated_on')
+    COLUMNS = __slots__
+    # the password hash is left out on purpose, it is only ever read to log in
+
+    id: int
+    username: str
+    role: int
+    display_name: Optional[str]
+    member_number: Optional[str]
+    timezone: Optional[str]
+    created: datetime.datetime
+    last_login: Optional[datetime.datetime]
+    active: int
+    deactivated_on: Optional[datetime.datetime]
+
+@dataclass
+class GameFile(Model):
+    __slots__ = ('id', 'post_id', 'file_name', 'content_id') + SUMMARY_COLUMNS
+    COLUMNS = __slots__
+
+    id: int
+    post_id: int
+    file_name: str
+    content_id: int
+    # summary columns from game_content, in SUMMARY_COLUMNS order
+    final_fen: Optional[str]
+    pgn_movetext: Optional[str]
+    ply_count: Optional[int]
+    pgn_white: Optional[str]
+    pgn_black: Optional[str]
+    pgn_event: Optional[str]
+    pgn_round: Optional[str]
+    pgn_date: Optional[str]
+    pgn_result: Optional[str]
+
+@dataclass
+class Post(Model):
+    """A post as listed on the index, with its author's names, how many games
+    it has and the first of them."""
+    __slots__ = ('id', 'title', 'body', 'created', 'author_id', 'username', 'display_name', 'member_number',
+                 'game_count', 'game')
+    COLUMNS = ('id', 'title', 'body', 'created', 'author_id')
+    AUTHOR_COLUMNS = ('username', 'display_name', 'member_number')
+
+    id: int
+    title: str
+    body: str
+    created: datetime.datetime
+    author_id: int
+    username: str
+    display_name: Optional[str]
+    member_number: Optional[str]
+    game_count: int
+    game: Optional[GameFile]
+
+    @classmethod
+    def listing_columns(cls):
+        # the columns from_row expects, from post p, user u, file f and game_content gc
+        return ', '.join(['p.' + e for e in cls.COLUMNS]
+                         + ['u.' + e for e in cls.AUTHOR_COLUMNS]
+                         + ['(SELECT count(id) FROM file WHERE post_id = p.id) AS game_count']
+                         + ['f.' + e for e in GameFile.COLUMNS[:4]]
+                         + ['gc.' + e for e in SUMMARY_COLUMNS])
+
+    @classmethod
+    def from_row(cls, row):
+        split = len(cls.COLUMNS) + len(cls.AUTHOR_COLUMNS) + 1
+        # posts without a game come back with a null file id
+        game = GameFile.from_row(row[split:]) if row[split] is not None else None
+        return cls(*row[:split], game)
@@ -0,0 +1,102 @@
+#Doublecheck - A web-based chess game database.
+#Copyright (C) 2024 Nick Edner
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU Affero General Public License as published
+#by the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU Affero General Public License for more details.
+
+#You should have received a copy of the GNU Affero General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from flask import current_app
+from werkzeug.security import check_password_hash, generate_password_hash
+
+import concurrent.futures
+import multiprocessing
+import threading
+
+class PasswordHasherBusy(Exception):
+    pass
+
+class PasswordHasher(object):
+    """Hashes and checks passwords in a small pool of worker processes, so a
+    burst of logins doesn't hold up every other request on the worker. At
+    most max_pending hashes are queued or running at once; anything waiting
+    longer than timeout seconds for its turn gives up with PasswordHasherBusy.
+    With workers set to 0, hashing is done inline instead."""
+
+    def __init__(self, method, workers=2, max_pending=8, timeout=10):
+        self.method = method
+        self.workers = workers
+        self.timeout = timeout
+        self._pending = threading.BoundedSemaphore(max_pending)
+        self._executor = None
+        self._lock = threading.Lock()
+        self._prefix = None
+
+    def _get_executor(self):
+        # the pool is only started once it's needed, so cli commands and
+        #   workers which never see a login don't pay for it
+        with self._lock:
+            if self._executor is None:
+                # forking a multi-threaded server can leave a worker process
+                #   holding a lock some other thread had, so they are started
+                #   fresh instead
+                method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+                self._executor = concurrent.futures.ProcessPoolExecutor(
+                        max_workers=self.workers, mp_context=multiprocessing.get_context(method))
+            return self._executor
+
+    def _run(self, fn, *args):
+        if self.workers == 0:
+            return fn(*args)
+        if not self._pending.acquire(timeout=self.timeout):
+            raise PasswordHasherBusy()
+        try:
+            return self._get_executor().submit(fn, *args).result()
+        finally:
+            self._pending.release()
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method)
+
+    def check(self, pwhash, password):
+        return self._run(check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        # werkzeug hashes start with the full method, e.g. "scrypt:32768:8:1$",
+        #   with any defaults the configured method leaves out filled in, so
+        #   the expected start is taken from a hash made with that method
+        prefix = self._prefix
+        if prefix is None or prefix[0] != self.method:
+            prefix = (self.method, generate_password_hash('', self.method).split('$', 1)[0])
+            self._prefix = prefix
+        return pwhash.split('$', 1)[0] != prefix[1]
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+def get_password_hasher():
+    return current_app.extensions['password_hasher']
+
+def hash_password(password):
+    return get_password_hasher().hash(password)
+
+def check_password(pwhash, password):
+    return get_password_hasher().check(pwhash, password)
+
+def init_app(app):
+    app.extensions['password_hasher'] = PasswordHasher(
+            app.config['PASSWORD_HASH_METHOD'],
+            workers=app.config['PASSWORD_HASH_WORKERS'],
+            max_pending=app.config['PASSWORD_HASH_MAX_PENDING'],
+            timeout=app.config['PASSWORD_HASH_TIMEOUT']
+            )
@@ -0,0 +1,373 @@
+#Doublecheck - A web-based chess game database.
+#Copyright (C) 2024 Nick Edner
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU Affero General Public License as published
+#by the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU Affero General Public License for more details.
+
+#You should have received a copy of the GNU Affero General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import chess, chess.pgn
+
+from array import array
+from collections import namedtuple
+import hashlib
+import io
+import pickle
+import re
+import sys
+import tempfile
+import zlib
+
+# headers we keep alongside each game, so listings never have to parse the PGN
+SUMMARY_HEADERS = ('White', 'Black', 'Event', 'Round', 'Date', 'Result')
+
+# columns in the game_content table which hold the derived game summary, in the order
+#   returned by summary_values
+SUMMARY_COLUMNS = ('final_fen', 'pgn_movetext', 'ply_count') + tuple(f'pgn_{e.lower()}' for e in SUMMARY_HEADERS)
+
+# stored game files are zlib compressed, behind a marker so they can be told
+#   apart from files stored as plain text before compression was added
+COMPRESSED_MARKER = b'DCZ1'
+
+def compress_pgn(text):
+    return COMPRESSED_MARKER + zlib.compress(text.encode('utf-8'))
+
+def decompress_pgn(value):
+    # takes whatever is stored in game_content.file_contents, compressed or not;
+    #   every read of the column goes through this, as databases created before
+    #   compression declare the column TEXT and return the compressed bytes as is
+    if isinstance(value, str):
+        return value
+    if value.startswith(COMPRESSED_MARKER):
+        return zlib.decompress(value[len(COMPRESSED_MARKER):]).decode('utf-8')
+    return value.decode('utf-8')
+
+def read_game(file_contents):
+    # we don't have to worry about read_game returning None here, since it
+    #   will only do that with an empty file and those are being filtered
+    #   out upon insertion to the db
+    return chess.pgn.read_game(io.StringIO(str(file_contents)))
+
+# the movetext kept for listings is the mainline only, without comments or NAGs
+SUMMARY_MOVETEXT_OPTIONS = {'columns': 40, 'headers': False, 'variations': False, 'comments': False}
+
+def summarize_headers(headers):
+    return {f'pgn_{e.lower()}': headers.get(e, '') for e in SUMMARY_HEADERS}
+
+def summarize_game(game):
+    end = game.end()
+    summary = {
+            'final_fen': end.board().fen(),
+            'pgn_movetext': game.accept(chess.pgn.StringExporter(**SUMMARY_MOVETEXT_OPTIONS)),
+            'ply_count': end.ply(),
+            }
+    summary.update(summarize_headers(game.headers))
+    return summary
+
+class SummaryVisitor(chess.pgn.StringExporter):
+    """Reads the same summary as summarize_game straight from the PGN text,
+    without building a game tree: variations are skipped by the parser
+    without their moves being parsed, and comments and NAGs are dropped."""
+
+    def __init__(self):
+        super().__init__(**SUMMARY_MOVETEXT_OPTIONS)
+        # starts from the same defaults as a parsed game's headers
+        self.game_headers = chess.pgn.Headers()
+        self.board = None
+        self.final_fen = None
+        self.ply_count = 0
+        self.result_visited = False
+
+    def visit_header(self, tagname, tagvalue):
+        self.game_headers[tagname] = tagvalue
+        super().visit_header(tagname, tagvalue)
+
+    def visit_board(self, board):
+        # the parser's mainline board, which it keeps moving along
+        self.board = board
+
+    def visit_result(self, result):
+        self.result_visited = True
+        # as read_game does, a result only in the movetext fills in the header
+        if self.game_headers.get('Result', '*') == '*':
+            self.game_headers['Result'] = result
+        super().visit_result(result)
+
+    def end_game(self):
+        # exported games always end with their result, even when the parser
+        #   stopped short of it
+        if not self.result_visited:
+            self.visit_result(self.game_headers.get('Result', '*'))
+        if self.board is not None:
+            self.final_fen = self.board.fen()
+            self.ply_count = self.board.ply()
+        super().end_game()
+
+    def handle_error(self, error):
+        # carry on past bad moves like read_game does, games are checked for
+        #   errors when they are uploaded
+        pass
+
+    def result(self):
+        summary = {
+                'final_fen': self.final_fen,
+                'pgn_movetext': super().result(),
+                'ply_count': self.ply_count,
+                }
+        summary.update(summarize_headers(self.game_headers))
+        return summary
+
+def read_summary(file_contents):
+    # for when only the summary of a stored game is needed, e.g. on listings
+    return chess.pgn.read_game(io.StringIO(str(file_contents)), Visitor=SummaryVisitor)
+
+def read_header_summary(file_contents):
+    # the summary's header columns, leaving the movetext unread
+    headers = chess.pgn.Headers()
+    headers.update(chess.pgn.read_headers(io.StringIO(str(file_contents))) or {})
+    return summarize_headers(headers)
+
+def summary_values(summary):
+    return tuple(summary[e] for e in SUMMARY_COLUMNS)
+
+class Position(namedtuple('Position', ('ply', 'fen', 'san', 'uci'))):
+    """One position in a game's mainline, with the move (in SAN and UCI)
+    that led to it, which is None for the starting position."""
+    __slots__ = ()
+
+    @property
+    def lastmove(self):
+        return chess.Move.from_uci(self.uci) if self.uci is not None else None
+
+def encode_moves(moves):
+    # 16 bits per move: from square, to square (6 bits each) and promotion
+    #   piece type (3 bits), stored little-endian
+    # a null move encodes as 0, since a1a1 is never a real move
+    encoded = array('H', (e.from_square | (e.to_square << 6) | ((e.promotion or 0) << 12) for e in moves))
+    if sys.byteorder == 'big':
+        encoded.byteswap()
+    return encoded.tobytes()
+
+def decode_moves(value):
+    encoded = array('H')
+    encoded.frombytes(value)
+    if sys.byteorder == 'big':
+        encoded.byteswap()
+    return [chess.Move(e & 0x3f, (e >> 6) & 0x3f, (e >> 12) or None) if e != 0 else chess.Move.null() for e in encoded]
+
+def replay_positions(start_fen, moves):
+    # builds the position index from the encoded mainline, which is much
+    #   faster than tokenizing the pgn text again
+    board = chess.Board(start_fen) if start_fen is not None else chess.Board()
+    positions = [Position(0, board.fen(), None, None)]
+    for ply, move in enumerate(decode_moves(moves), start=1):
+        san = board.san(move)
+        board.push(move)
+        positions.append(Position(ply, board.fen(), san, move.uci()))
+    return positions
+
+class GameData(namedtuple('GameData', ('pgn', 'content_hash', 'summary', 'start_fen', 'moves'))):
+    """Everything stored for a game, all derived from one parse of it."""
+    __slots__ = ()
+
+def derive_game_data(ingested):
+    game = ingested.game
+    return GameData(
+            ingested.pgn,
+            ingested.content_hash,
+            summarize_game(game),
+            game.headers.get('FEN'),
+            encode_moves(game.mainline_moves()),
+            )
+
+class StagedGames(object):
+    """Derived games waiting to be saved, pickled one at a time into a temp
+    file which stays in memory up to max_memory bytes and goes to disk past
+    that, so an upload of any number of games only holds one in memory. They
+    can be read back any number of times, e.g. when a busy write is retried."""
+
+    def __init__(self, max_memory=1024*1024):
+        self._file = tempfile.SpooledTemporaryFile(max_size=max_memory)
+        self._count = 0
+
+    def append(self, game_data):
+        pickle.dump(tuple(game_data), self._file, protocol=pickle.HIGHEST_PROTOCOL)
+        self._count += 1
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        self._file.seek(0)
+        for _ in range(self._count):
+            yield GameData(*pickle.load(self._file))
+
+    def close(self):
+        self._file.close()
+
+def game_hash(game):
+    # identifies a game by its key headers and mainline moves only, so the same
+    #   game with different whitespace, comments or variations hashes the same
+    headers = [game.headers.get(e, '').strip() for e in SUMMARY_HEADERS]
+    fen = game.headers.get('FEN', '').strip()
+    moves = [e.uci() for e in game.mainline_moves()]
+    return hashlib.sha256('\n'.join(headers + [fen, ' '.join(moves)]).encode('utf-8')).hexdigest()
+
+def save_game_content(db, game_data):
+    # the same game shares one stored copy, along with its summary and moves;
+    #   gives its id, and whether the stored copy has this game's own text
+    cursor = db.execute(f'INSERT OR IGNORE INTO game_content (content_hash, file_contents, start_fen, moves, {", ".join(SUMMARY_COLUMNS)})'
+                        f' VALUES (?, ?, ?, ?{", ?" * len(SUMMARY_COLUMNS)})',
+                        (game_data.content_hash, compress_pgn(game_data.pgn), game_data.start_fen, game_data.moves)
+                        + summary_values(game_data.summary)
+                        )
+    if cursor.rowcount == 0:
+        content = db.execute('SELECT id, file_contents FROM game_content WHERE content_hash = ?',
+                             (game_data.content_hash,)).fetchone()
+        return content['id'], decompress_pgn(content['file_contents']) == game_data.pgn
+    return cursor.lastrowid, True
+
+def save_game_file(db, uploader_id, post_id, file_name, game_data):
+    content_id, same_text = save_game_content(db, game_data)
+    # the same game with other comments or variations keeps its own text
+    cursor = db.execute('INSERT INTO file (uploader_id, post_id, file_name, content_id, file_contents) VALUES (?, ?, ?, ?, ?)',
+                        (uploader_id, post_id, file_name, content_id, None if same_text else compress_pgn(game_data.pgn))
+                        )
+    return cursor.lastrowid
+
+# a tag pair on its own line, e.g. [White "Carlsen, Magnus"]
+TAG_LINE = re.compile(r'\[\s*[A-Za-z0-9_]+\s+"(?:[^"\\]|\\.)*"\s*\]')
+
+# a game termination marker, which ends a game's movetext
+RESULT = re.compile(r'(?:1-0|0-1|1/2-1/2|\*)(?=\s|$)')
+
+def split_movetext(line, in_comment):
+    # splits a line of movetext just after each termination marker outside
+    #   comments, giving for each part whether it has anything besides
+    #   comments and whitespace and whether it ends a game, along with
+    #   whether a {} comment is still open at the end of the line; braces
+    #   after a ; comment don't count, it runs to the end of the line
+    parts = []
+    start = 0
+    has_moves = False
+    i = 0
+    while i < len(line):
+        char = line[i]
+        if in_comment:
+            if char == '}':
+                in_comment = False
+        elif char == '{':
+            in_comment = True
+        elif char == ';':
+            break
+        elif not char.isspace():
+            match = RESULT.match(line, i) if i == 0 or line[i-1].isspace() or line[i-1] in '})' else None
+            if match is not None:
+                parts.append((line[start:match.end()], has_moves, True))
+                start = i = match.end()
+                has_moves = False
+                continue
+            has_moves = True
+        i += 1
+    parts.append((line[start:], has_moves, False))
+    return parts, in_comment
+
+def iter_pgn_chunks(handle):
+    # splits a pgn file with many games into the text of each game, without
+    #   reading more than one game into memory at a time
+    # a game starts at the first tag line that comes after some movetext, or
+    #   after the blank line ending a game that only has tags, and at the
+    #   first move after a termination marker, for games without tags; lines
+    #   inside {} comments are never tags, however they look
+    lines = []
+    seen_tags = False
+    seen_movetext = False
+    tags_ended = False
+    game_ended = False
+    in_comment = False
+    for line in handle:
+        stripped = line.strip()
+        if not in_comment and TAG_LINE.fullmatch(stripped):
+            if seen_movetext or tags_ended:
+                yield ''.join(lines)
+                lines = []
+                seen_movetext = False
+                tags_ended = False
+                game_ended = False
+            seen_tags = True
+        elif stripped == '':
+            if seen_tags and not seen_movetext:
+                tags_ended = True
+        elif in_comment or not line.startswith('%'):
+            parts, in_comment = split_movetext(line, in_comment)
+            for part, has_moves, ends_game in parts:
+                if game_ended and has_moves:
+                    yield ''.join(lines)
+                    lines = []
+                    tags_ended = False
+                    game_ended = False
+                if part.strip():
+                    seen_movetext = True
+                game_ended = game_ended or ends_game
+                lines.append(part)
+            continue
+        lines.append(line)
+    if seen_tags or seen_movetext:
+        yield ''.join(lines)
+
+class IngestedGame(namedtuple('IngestedGame', ('game', 'pgn', 'content_hash', 'error'))):
+    """The result of ingesting one game: the parsed game, its normalized pgn
+    text and hash, and an error message if it didn't pass validation."""
+    __slots__ = ()
+
+def check_game_for_errors(game, game_text):
+    # game must successfully parse as PGN
+    if game is None or len(game.errors) > 0:
+        return f"Invalid PGN: errors encountered while parsing: {str(game.errors) if game is not None else ''}"
+    # the parser is VERY loose, even if the file looks nothing like a PGN it will
+    #   still usually parse out at least one move of 1. --
+    first_move = game.next()
+    if first_move is None or str(first_move)[:5] == '1. --':
+        return f"Invalid PGN, unable to parse first move: {game_text[:200]}"
+    # all validations passed
+    return None
+
+def has_annotations(game):
+    # whether the game has anything besides its mainline moves: comments,
+    #   NAGs or variations
+    bare = chess.pgn.StringExporter(columns=None, headers=False, comments=False, variations=False)
+    return game.accept(bare) != game.accept(chess.pgn.StringExporter(columns=None, headers=False))
+
+def normalize_game(game):
+    # the canonical form we store: seven tag roster first, then any other
+    #   headers, and the movetext (with comments and variations) on one line
+    return game.accept(chess.pgn.StringExporter(columns=None))
+
+def ingest_game(game_text):
+    # the only time a game's text is parsed: everything else (validation,
+    #   normalization, hash, summary, moves) works from the parsed game
+    game = chess.pgn.read_game(io.StringIO(game_text))
+    error = check_game_for_errors(game, game_text)
+    if error is not None:
+        return IngestedGame(game, None, None, error)
+    return IngestedGame(game, normalize_game(game), game_hash(game), None)
+
+def ingest_pgn(text_stream):
+    # decoding is up to the text stream, so this works on uploads and files alike
+    for game_text in iter_pgn_chunks(text_stream):
+        yield ingest_game(game_text)
+
+def parse_game_chunk(chunk):
+    # runs in worker processes during bulk imports, so everything returned
+    #   has to be picklable
+    ingested = ingest_game(chunk)
+    if ingested.error is not None:
+        return None
+    return derive_game_data(ingested)
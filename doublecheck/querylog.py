@@ -0,0 +1,228 @@
+#Doublecheck - A web-based chess game database.
+#Copyright (C) 2024 Nick Edner
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU Affero General Public License as published
+#by the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU Affero General Public License for more details.
+
+#You should have received a copy of the GNU Affero General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from collections import deque
+
+import sqlite3
+import threading
+import time
+
+from flask import current_app, g, has_app_context, has_request_context, request
+
+from doublecheck.cache import LRUCache
+
+# only these can be run through EXPLAIN QUERY PLAN
+EXPLAINABLE = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'REPLACE', 'WITH')
+
+def explain(db, sql, parameters=()):
+    # run on a plain cursor, so explaining a query doesn't get logged itself
+    try:
+        rows = db.cursor(sqlite3.Cursor).execute(f'EXPLAIN QUERY PLAN {sql}', parameters).fetchall()
+    except (sqlite3.Error, ValueError):
+        return None
+    return [row[3] for row in rows]
+
+def is_table_scan(detail):
+    # e.g. "SCAN post", as opposed to "SCAN p USING INDEX post_created_id"
+    #   or "SEARCH u USING INTEGER PRIMARY KEY (rowid=?)"
+    return (detail.startswith('SCAN ') and ' USING ' not in detail
+            and not detail.startswith('SCAN CONSTANT ROW'))
+
+class QueryRecord(object):
+    """One execution of a statement, kept up to date as its rows are fetched."""
+    __slots__ = ('sql', 'parameters', 'rows', 'ms', 'stats', 'slow')
+
+    def __init__(self, sql, parameters, rows, ms, stats):
+        self.sql = sql
+        self.parameters = parameters
+        self.rows = rows
+        self.ms = ms
+        self.stats = stats
+        self.slow = False
+
+class QueryLog(object):
+    """Process-wide timings for every distinct statement, plus the most recent
+    executions which took longer than slow_ms, with their query plans."""
+
+    def __init__(self, slow_ms, max_statements=500, max_slow=50, max_per_request=500, max_explained=500):
+        self.slow_ms = slow_ms
+        self.max_statements = max_statements
+        self.max_per_request = max_per_request
+        self._statements = {}
+        self._slow = deque(maxlen=max_slow)
+        # plans of the slow statements explained so far, so each is only
+        #   explained again once it has dropped out
+        self._explained = LRUCache(max_explained)
+        self._lock = threading.Lock()
+
+    def start(self, db, sql, parameters, rows, seconds):
+        sql = ' '.join(sql.split())
+        ms = seconds * 1000
+        with self._lock:
+            stats = self._statements.get(sql)
+            if stats is None:
+                stats = {'sql': sql, 'calls': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'rows': 0, 'plan': None, 'scans': False}
+                # statements past the limit are still timed per request,
+                #   just not kept for the whole process
+                if len(self._statements) < self.max_statements:
+                    self._statements[sql] = stats
+            stats['calls'] += 1
+            stats['total_ms'] += ms
+            stats['rows'] += rows
+            stats['max_ms'] = max(stats['max_ms'], ms)
+        record = QueryRecord(sql, 0 if parameters is None else len(parameters), rows, ms, stats)
+        if has_app_context():
+            queries = g.setdefault('queries', [])
+            if len(queries) < self.max_per_request:
+                queries.append(record)
+        self._check_slow(db, record, parameters)
+        return record
+
+    def update(self, db, record, parameters, rows, seconds):
+        ms = seconds * 1000
+        record.rows += rows
+        record.ms += ms
+        stats = record.stats
+        with self._lock:
+            stats['total_ms'] += ms
+            stats['rows'] += rows
+            stats['max_ms'] = max(stats['max_ms'], record.ms)
+        self._check_slow(db, record, parameters)
+
+    def _check_slow(self, db, record, parameters):
+        if record.slow or record.ms < self.slow_ms:
+            return
+        record.slow = True
+        self._explain(db, record, parameters)
+        endpoint = request.endpoint if has_request_context() else None
+        with self._lock:
+            self._slow.append({'sql': record.sql, 'parameters': record.parameters, 'endpoint': endpoint,
+                               'record': record, 'plan': record.stats['plan']})
+        if has_app_context():
+            current_app.logger.warning('Slow query (%.1f ms, %s): %s', record.ms, endpoint, record.sql)
+
+    def _explain(self, db, record, parameters):
+        # only slow statements are explained, as explaining one costs about
+        #   as much as running it
+        if parameters is None or record.sql.split(' ', 1)[0].upper() not in EXPLAINABLE:
+            return
+        plan = self._explained.get(record.sql)
+        if plan is None:
+            plan = explain(db, record.sql, parameters) or []
+            self._explained.put(record.sql, plan)
+        with self._lock:
+            record.stats['plan'] = plan
+            record.stats['scans'] = any(is_table_scan(e) for e in plan)
+
+    def slowest(self, count=20):
+        with self._lock:
+            statements = list(self._statements.values())
+        return sorted(statements, key=lambda e: e['max_ms'], reverse=True)[:count]
+
+    def scans(self):
+        with self._lock:
+            return [e for e in self._statements.values() if e['scans']]
+
+    def slow_queries(self):
+        # rows and time keep adding up while a slow query is still being fetched
+        with self._lock:
+            slow = list(self._slow)
+        return [dict(e, rows=e['record'].rows, ms=e['record'].ms) for e in reversed(slow)]
+
+    def clear(self):
+        with self._lock:
+            self._statements.clear()
+            self._slow.clear()
+        self._explained.clear()
+
+class TimedCursor(sqlite3.Cursor):
+    """A cursor which times each statement, including fetching its rows."""
+    _record = None
+    _parameters = None
+
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        super().execute(sql, parameters)
+        self._start(sql, parameters, start)
+        return self
+
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        super().executemany(sql, seq_of_parameters)
+        self._start(sql, None, start)
+        return self
+
+    def _start(self, sql, parameters, start):
+        seconds = time.perf_counter() - start
+        # select rows are counted as they're fetched, other statements count
+        #   the rows they changed
+        rows = 0 if self.description is not None else max(self.rowcount, 0)
+        self._parameters = parameters
+        self._record = self.connection.query_log.start(self.connection, sql, parameters, rows, seconds)
+
+    def _fetched(self, rows, start):
+        if self._record is not None:
+            self.connection.query_log.update(self.connection, self._record, self._parameters, rows,
+                                             time.perf_counter() - start)
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super().fetchone()
+        self._fetched(0 if row is None else 1, start)
+        return row
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._fetched(len(rows), start)
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        self._fetched(len(rows), start)
+        return rows
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self._fetched(0, start)
+            raise
+        self._fetched(1, start)
+        return row
+
+class TimedConnection(sqlite3.Connection):
+    """A connection whose statements are all timed into query_log."""
+    query_log = None
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+def get_query_log():
+    if not current_app.config['QUERY_LOG']:
+        return None
+    query_log = current_app.extensions.get('query_log')
+    if query_log is None:
+        query_log = QueryLog(current_app.config['SLOW_QUERY_THRESHOLD_MS'])
+        current_app.extensions['query_log'] = query_log
+    return query_log
@@ -18,6 +18,12 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 DROP TABLE IF EXISTS user;
 DROP TABLE IF EXISTS post;
 DROP TABLE IF EXISTS file;
+DROP TABLE IF EXISTS game_content;
+DROP TABLE IF EXISTS game_position;
+DROP TABLE IF EXISTS pgn_import;
+DROP TABLE IF EXISTS setting;
+DROP TABLE IF EXISTS setting_version;
+DROP TABLE IF EXISTS post_version;
 
 CREATE TABLE user (
   id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -50,7 +56,82 @@ CREATE TABLE file (
   post_id INTEGER NOT NULL,
   created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
   file_name TEXT NOT NULL,
-  file_contents TEXT NOT NULL,
+  content_id INTEGER NOT NULL,
+  -- this file's own pgn, only when it differs from the shared copy in
+  --   game_content, e.g. the same game with other annotations
+  file_contents BLOB NULL,
   FOREIGN KEY (uploader_id) REFERENCES user (id),
-  FOREIGN KEY (post_id) REFERENCES post (id)
+  FOREIGN KEY (post_id) REFERENCES post (id),
+  FOREIGN KEY (content_id) REFERENCES game_content (id)
 );
+
+-- the same game uploaded more than once shares one game_content row
+CREATE TABLE game_content (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  content_hash TEXT UNIQUE NOT NULL,
+  -- compressed by compress_pgn, or text if stored before compression
+  file_contents BLOB NOT NULL,
+  -- the mainline packed 16 bits per move, from start_fen (null for the usual start)
+  start_fen TEXT NULL,
+  moves BLOB NULL,
+  final_fen TEXT NULL,
+  pgn_movetext TEXT NULL,
+  ply_count INTEGER NULL,
+  pgn_white TEXT NULL,
+  pgn_black TEXT NULL,
+  pgn_event TEXT NULL,
+  pgn_round TEXT NULL,
+  pgn_date TEXT NULL,
+  pgn_result TEXT NULL
+);
+
+CREATE TABLE pgn_import (
+  source TEXT PRIMARY KEY,
+  games_read INTEGER NOT NULL DEFAULT 0,
+  games_imported INTEGER NOT NULL DEFAULT 0,
+  updated TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+-- config values changed at runtime, as json
+CREATE TABLE setting (
+  name TEXT PRIMARY KEY,
+  value TEXT NOT NULL
+);
+
+-- bumped on every settings change, so workers know to reload them
+CREATE TABLE setting_version (
+  id INTEGER PRIMARY KEY CHECK (id = 1),
+  version INTEGER NOT NULL
+);
+INSERT INTO setting_version (id, version) VALUES (1, 0);
+
+-- bumped by the triggers below on every change to the post listing: posts,
+--   their files and their authors' names; the index ETag is built from it
+CREATE TABLE post_version (
+  id INTEGER PRIMARY KEY CHECK (id = 1),
+  version INTEGER NOT NULL
+);
+INSERT INTO post_version (id, version) VALUES (1, 0);
+
+CREATE TRIGGER post_version_post_insert AFTER INSERT ON post
+BEGIN UPDATE post_version SET version = version + 1 WHERE id = 1; END;
+CREATE TRIGGER post_version_post_update AFTER UPDATE ON post
+BEGIN UPDATE post_version SET version = version + 1 WHERE id = 1; END;
+CREATE TRIGGER post_version_post_delete AFTER DELETE ON post
+BEGIN UPDATE post_version SET version = version + 1 WHERE id = 1; END;
+CREATE TRIGGER post_version_file_insert AFTER INSERT ON file
+BEGIN UPDATE post_version SET version = version + 1 WHERE id = 1; END;
+CREATE TRIGGER post_version_file_update AFTER UPDATE ON file
+BEGIN UPDATE post_version SET version = version + 1 WHERE id = 1; END;
+CREATE TRIGGER post_version_file_delete AFTER DELETE ON file
+BEGIN UPDATE post_version SET version = version + 1 WHERE id = 1; END;
+CREATE TRIGGER post_version_user_update AFTER UPDATE OF username, display_name, member_number ON user
+BEGIN UPDATE post_version SET version = version + 1 WHERE id = 1; END;
+
+CREATE INDEX post_created_id ON post (created, id);
+CREATE INDEX file_post_id ON file (post_id);
+CREATE INDEX file_content_id ON file (content_id);
+CREATE INDEX game_content_final_fen ON game_content (final_fen);
+CREATE INDEX user_role_id ON user (role, id);
+CREATE INDEX user_member_number ON user (member_number);
+CREATE INDEX user_active_id ON user (active, id);
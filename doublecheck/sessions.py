@@ -0,0 +1,170 @@
+#Doublecheck - A web-based chess game database.
+#Copyright (C) 2024 Nick Edner
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU Affero General Public License as published
+#by the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU Affero General Public License for more details.
+
+#You should have received a copy of the GNU Affero General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SecureCookieSession, SessionInterface
+
+import datetime
+import secrets
+import sqlite3
+import threading
+
+class ServerSideSession(SecureCookieSession):
+    """Session data kept on the server, the cookie only carries the id."""
+
+    def __init__(self, initial=None, sid=None, new=False):
+        super().__init__(initial)
+        self.sid = sid if sid is not None else new_session_id()
+        self.new = new
+        self.stale_sid = None
+
+    def clear(self):
+        # a cleared session (e.g. on login or logout) gets a fresh id, so an
+        #   id handed out before login can't be reused afterwards
+        super().clear()
+        if not self.new:
+            self.stale_sid = self.sid
+        self.sid = new_session_id()
+        self.new = True
+
+def new_session_id():
+    return secrets.token_urlsafe(32)
+
+class MemorySessionStore(object):
+    """Sessions kept in a dict, only useful for testing or a single worker."""
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def load(self, sid, now):
+        with self._lock:
+            entry = self._data.get(sid)
+            if entry is None:
+                return None
+            value, expiry = entry
+            if expiry < now:
+                del self._data[sid]
+                return None
+            return value
+
+    def save(self, sid, value, expiry):
+        with self._lock:
+            self._data[sid] = (value, expiry)
+
+    def delete(self, sid):
+        with self._lock:
+            self._data.pop(sid, None)
+
+class SqliteSessionStore(object):
+    """Sessions kept in their own sqlite db, shared between all workers."""
+
+    def __init__(self, path):
+        # nothing is opened until the first session is loaded or saved, so
+        #   creating an app (e.g. to run a cli command) doesn't create the db
+        self.path = path
+        self._local = threading.local()
+
+    def _connect(self):
+        # sqlite connections can't be shared between threads, so keep one per thread
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, isolation_level=None)
+            db.execute(
+                    'CREATE TABLE IF NOT EXISTS session ('
+                    '  id TEXT PRIMARY KEY,'
+                    '  data TEXT NOT NULL,'
+                    '  expiry TIMESTAMP NOT NULL'
+                    ')'
+                    )
+            self._local.db = db
+        return db
+
+    def load(self, sid, now):
+        row = self._connect().execute('SELECT data, expiry FROM session WHERE id = ?', (sid,)).fetchone()
+        if row is None or row[1] < now.isoformat(' '):
+            return None
+        return row[0]
+
+    def save(self, sid, value, expiry):
+        db = self._connect()
+        db.execute('INSERT OR REPLACE INTO session (id, data, expiry) VALUES (?, ?, ?)',
+                   (sid, value, expiry.isoformat(' '))
+                   )
+        # clear out expired sessions every so often
+        if secrets.randbelow(100) == 0:
+            db.execute('DELETE FROM session WHERE expiry < ?', (now_utc().isoformat(' '),))
+
+    def delete(self, sid):
+        self._connect().execute('DELETE FROM session WHERE id = ?', (sid,))
+
+def now_utc():
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+class ServerSideSessionInterface(SessionInterface):
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self, store):
+        self.store = store
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            value = self.store.load(sid, now_utc())
+            if value is not None:
+                return ServerSideSession(self.serializer.loads(value), sid=sid)
+        return ServerSideSession(new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        secure = self.get_cookie_secure(app)
+        samesite = self.get_cookie_samesite(app)
+        httponly = self.get_cookie_httponly(app)
+
+        if session.accessed:
+            response.vary.add('Cookie')
+
+        if session.stale_sid is not None:
+            self.store.delete(session.stale_sid)
+
+        # If the session is modified to be empty, remove it and the cookie.
+        if not session:
+            if session.modified:
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path, secure=secure, samesite=samesite, httponly=httponly)
+                response.vary.add('Cookie')
+            return
+
+        if not self.should_set_cookie(app, session):
+            return
+
+        expires = self.get_expiration_time(app, session)
+        # non-permanent sessions end with the browser, but still need to
+        #   expire from the store eventually
+        expiry = now_utc() + app.permanent_session_lifetime
+        self.store.save(session.sid, self.serializer.dumps(dict(session)), expiry)
+        response.set_cookie(name, session.sid, expires=expires, httponly=httponly, domain=domain, path=path, secure=secure, samesite=samesite)
+        response.vary.add('Cookie')
+
+def init_app(app):
+    backend = app.config['SESSION_BACKEND']
+    if backend == 'sqlite':
+        app.session_interface = ServerSideSessionInterface(SqliteSessionStore(app.config['SESSION_DATABASE']))
+    elif backend == 'memory':
+        app.session_interface = ServerSideSessionInterface(MemorySessionStore())
+    elif backend != 'cookie':
+        raise ValueError(f'Unknown SESSION_BACKEND {backend}')
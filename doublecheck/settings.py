@@ -0,0 +1,97 @@
+#Doublecheck - A web-based chess game database.
+#Copyright (C) 2024 Nick Edner
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU Affero General Public License as published
+#by the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU Affero General Public License for more details.
+
+#You should have received a copy of the GNU Affero General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from flask import current_app, request
+
+from doublecheck.db import get_db, run_write
+
+import json
+import sqlite3
+import threading
+
+class SettingsStore(object):
+    """Config values changed at runtime, kept in the setting table so every
+    worker sees them. Each worker remembers the setting_version it last
+    loaded, and only reloads the settings into app.config when the version
+    has moved on, so the check on each request is a single row lookup."""
+
+    def __init__(self):
+        self.version = None
+        # whether this worker has checked for a first user yet; until it has,
+        #   CREATE_FIRST_USER_AS_ADMIN is treated as off, see first_user_is_admin
+        self.first_user_checked = False
+        self._lock = threading.Lock()
+
+    def sync(self, app):
+        try:
+            self._sync(app)
+        except sqlite3.OperationalError as e:
+            # e.g. the db is locked, or hasn't been initialized yet; nothing
+            #   is marked as loaded, so the next request tries again
+            app.logger.warning('Settings not synced: %s', e)
+
+    def _sync(self, app):
+        db = get_db()
+        version = db.execute('SELECT version FROM setting_version WHERE id = 1').fetchone()[0]
+        if version != self.version:
+            rows = db.execute('SELECT name, value FROM setting').fetchall()
+            with self._lock:
+                app.config.update({e['name']: json.loads(e['value']) for e in rows})
+                self.version = version
+        # whether the first user is still to come is checked once per worker;
+        #   after that, registering the first user turns it off for everyone
+        if not self.first_user_checked:
+            if app.config.get('CREATE_FIRST_USER_AS_ADMIN', False):
+                if db.execute('SELECT 1 FROM user LIMIT 1').fetchone() is not None:
+                    app.config['CREATE_FIRST_USER_AS_ADMIN'] = False
+            self.first_user_checked = True
+
+    def first_user_is_admin(self, app):
+        # never true while the check for users is unresolved, so a worker
+        #   which couldn't sync doesn't hand out admin to a later user
+        return self.first_user_checked and app.config.get('CREATE_FIRST_USER_AS_ADMIN', False)
+
+    def update(self, app, values):
+        def save_settings(db):
+            db.executemany('INSERT INTO setting (name, value) VALUES (?, ?)'
+                           ' ON CONFLICT (name) DO UPDATE SET value = excluded.value',
+                           [(name, json.dumps(value)) for name, value in values.items()])
+            db.execute('UPDATE setting_version SET version = version + 1 WHERE id = 1')
+            return db.execute('SELECT version FROM setting_version WHERE id = 1').fetchone()[0]
+        version = run_write(save_settings)
+        with self._lock:
+            app.config.update(values)
+            # other changes made in between are picked up on the next sync
+            if self.version is not None and version == self.version + 1:
+                self.version = version
+
+def get_settings():
+    return current_app.extensions['settings']
+
+def first_user_is_admin():
+    return get_settings().first_user_is_admin(current_app)
+
+def update_settings(values):
+    get_settings().update(current_app._get_current_object(), values) # pyright: ignore
+
+def sync_settings():
+    # static files don't depend on any settings
+    if request.endpoint == 'static':
+        return
+    get_settings().sync(current_app._get_current_object()) # pyright: ignore
+
+def init_app(app):
+    app.extensions['settings'] = SettingsStore()
+    app.before_request(sync_settings)
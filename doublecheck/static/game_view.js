@@ -0,0 +1,96 @@
+/*
+Doublecheck - A web-based chess game database.
+Copyright (C) 2024 Nick Edner
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+*/
+
+// Steps through a game in the browser using the game's positions.json, so
+//   the move buttons don't need a round trip to the server. Without
+//   javascript the buttons still post back to the server as usual.
+(function () {
+  'use strict';
+
+  var view = document.getElementById('game-view');
+  if (!view || !window.fetch) {
+    return;
+  }
+
+  var positions = null;
+  var ply = parseInt(view.dataset.ply, 10);
+
+  // board images are served per ply and cached by the browser, so stepping
+  //   back over a move doesn't fetch its board again
+  function showBoard() {
+    var image = document.querySelector('#game-board img');
+    image.src = image.src.replace(/\d+\.svg$/, ply + '.svg');
+    image.alt = 'Turn ' + ply;
+  }
+
+  // formats the moves the way the pgn exporter does, e.g. "1. e4 e5" or "8... Rxf7"
+  function formatMoves(startPly) {
+    var parts = [];
+    for (var i = startPly; i < positions.length; i++) {
+      var fields = positions[i - 1].fen.split(' ');
+      if (fields[1] === 'w') {
+        parts.push(fields[5] + '. ' + positions[i].san);
+      } else if (i === startPly) {
+        parts.push(fields[5] + '... ' + positions[i].san);
+      } else {
+        parts.push(positions[i].san);
+      }
+    }
+    return parts.join(' ');
+  }
+
+  function show(newPly) {
+    var last = positions.length - 1;
+    ply = Math.max(0, Math.min(newPly, last));
+    showBoard();
+    document.getElementById('game-ply').textContent = ply;
+    document.getElementById('game-movetext').textContent = formatMoves(Math.max(ply, 1));
+    view.querySelectorAll('input[name=firstMove], input[name=prevMove]').forEach(function (button) {
+      button.disabled = ply === 0;
+    });
+    view.querySelectorAll('input[name=nextMove], input[name=lastMove]').forEach(function (button) {
+      button.disabled = ply === last;
+    });
+  }
+
+  view.addEventListener('submit', function (event) {
+    if (positions === null || !event.submitter) {
+      return;
+    }
+    event.preventDefault();
+    var steps = {
+      firstMove: -Infinity,
+      prevMove: -1,
+      nextMove: 1,
+      lastMove: Infinity
+    };
+    var step = steps[event.submitter.name];
+    if (step === -Infinity) {
+      show(0);
+    } else if (step === Infinity) {
+      show(positions.length - 1);
+    } else if (step !== undefined) {
+      show(ply + step);
+    }
+  });
+
+  fetch(view.dataset.positionsUrl)
+    .then(function (response) { return response.json(); })
+    .then(function (data) { positions = data.positions; })
+    .catch(function () { positions = null; });
+})();
@@ -19,6 +19,7 @@ import tempfile
 import pytest
 from doublecheck import create_app
 from doublecheck.db import get_db, init_db
+from doublecheck.querylog import get_query_log
 
 with open(os.path.join(os.path.dirname(__file__), 'data.sql'), 'rb') as f:
     _data_sql = f.read().decode('utf8')
@@ -30,6 +31,9 @@ def app_with_no_data():
     app = create_app({
         'TESTING': True,
         'DATABASE': db_path,
+        'BOARD_CACHE_DIR': None,
+        'SESSION_BACKEND': 'memory',
+        'PASSWORD_HASH_WORKERS': 0,
         })
 
     with app.app_context():
@@ -47,6 +51,15 @@ def app(app_with_no_data):
         get_db().executescript(_data_sql)
     return app_with_no_data
 
+@pytest.fixture
+def query_log(app):
+    # queries are only timed on connections opened once the log is on, so
+    #   each app context opens its own
+    app.config['QUERY_LOG'] = True
+    app.config['DATABASE_PERSISTENT_CONNECTIONS'] = False
+    with app.app_context():
+        return get_query_log()
+
 @pytest.fixture
 def client(app):
     return app.test_client()
@@ -26,6 +26,12 @@ VALUES
   ('test title', 'test' || x'0a' || 'body', 1, '2018-01-01 00:00:00'),
   ('test title 2', 'test' || x'0a' || 'body 2', 2, '2018-01-01 00:00:00');
 
-INSERT INTO file (uploader_id, post_id, file_name, file_contents)
+-- a game the way migrate-db leaves one stored before game_content: hashed,
+--   with its text as it was stored and no derived data until refresh-game-data
+INSERT INTO game_content (content_hash, file_contents)
 VALUES
-  (2, 2, 'test_file.pgn', 'b''[Event ""test event""]\n[Site ""test site""]\n[Date ""2023.10.17""]\n[Round ""4""]\n[White ""foo""]\n[Black ""bar""]\n[Result ""0-1""]\n\n1. e4 e5 2. d4 Nf6 3. Nc3 Nc6 4. d5 Nd4 5. Nf3 c5 6. Nxe5 Bd6 7. Bf4 O-O { test comment } 8. Nxf7 Rxf7 0-1\''');
+  ('cabba13f9957956e13506b983f2377be7a101098e46170506f1e16649f332b54', 'b''[Event ""test event""]\n[Site ""test site""]\n[Date ""2023.10.17""]\n[Round ""4""]\n[White ""foo""]\n[Black ""bar""]\n[Result ""0-1""]\n\n1. e4 e5 2. d4 Nf6 3. Nc3 Nc6 4. d5 Nd4 5. Nf3 c5 6. Nxe5 Bd6 7. Bf4 O-O { test comment } 8. Nxf7 Rxf7 0-1\''');
+
+INSERT INTO file (uploader_id, post_id, file_name, content_id)
+VALUES
+  (2, 2, 'test_file.pgn', 1);
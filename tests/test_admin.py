@@ -196,6 +196,70 @@ def test_activate_user(client, auth, app):
         assert user_status['active'] == 1
         assert user_status['deactivated_on'] == None
 
+def test_user_cp_filter_sort_page(client, auth, app):
+    with app.app_context():
+        db = get_db()
+        db.executemany('INSERT INTO user (username, password, role, member_number) VALUES (?, ?, ?, ?)',
+                       [(f'member{n:02}', 'x', Roles.USER.value, f'{100+n}') for n in range(30)])
+        db.execute('UPDATE user SET active = 0 WHERE username = ?', ('member05',))
+        db.commit()
+    app.config['USERS_PER_PAGE'] = 10
+    auth.login(username='admin', password='b')
+
+    # 33 users, 10 to a page, admins first
+    response = client.get('/admin/user_cp')
+    assert b'33 user(s)' in response.data
+    assert b'Page 1 of 4' in response.data
+    assert response.data.index(b'admin') < response.data.index(b'member00')
+    assert b'member09' not in response.data
+    response = client.get('/admin/user_cp?page=4')
+    assert b'member29' in response.data
+
+    # username and member number match by prefix
+    response = client.get('/admin/user_cp?username=member1')
+    assert b'10 user(s)' in response.data
+    response = client.get('/admin/user_cp?member_number=129')
+    assert b'1 user(s)' in response.data
+    assert b'member29' in response.data
+    response = client.get('/admin/user_cp?active=0')
+    assert b'1 user(s)' in response.data
+    assert b'member05' in response.data
+    response = client.get(f'/admin/user_cp?role={Roles.ADMIN.value}')
+    assert b'1 user(s)' in response.data
+
+    response = client.get('/admin/user_cp?sort=username&dir=desc')
+    assert b'member29' in response.data
+    assert response.data.index(b'member29') < response.data.index(b'member28')
+
+    # the filters are backed by indexes rather than scanning the user table
+    with app.app_context():
+        for where, params in (('role = ?', (1,)), ('active = ?', (0,)), ('member_number >= ? AND member_number < ?', ('1', '2'))):
+            plan = get_db().execute(f'EXPLAIN QUERY PLAN SELECT id FROM user WHERE {where} ORDER BY id', params).fetchall()
+            assert 'USING' in plan[0]['detail']
+
+def test_user_cp_bulk_actions(client, auth, app):
+    auth.login(username='admin', password='b')
+    response = client.post(
+            '/admin/user_cp?username=o',
+            data={'bulk_action': 'deactivate', 'user_id': ['1', '2', '3']}
+            )
+    # the page's filters are kept
+    assert response.headers['Location'] == '/admin/user_cp?username=o'
+    with app.app_context():
+        users = get_db().execute('SELECT id, active, role FROM user ORDER BY id').fetchall()
+        # but not for the admin's own account
+        assert [e['active'] for e in users] == [0, 0, 1]
+
+    client.post('/admin/user_cp', data={'bulk_action': 'role', 'bulk_role': 'MODERATOR', 'user_id': ['1', '2']})
+    client.post('/admin/user_cp', data={'bulk_action': 'activate', 'user_id': ['1', '2']})
+    with app.app_context():
+        users = get_db().execute('SELECT id, active, role FROM user ORDER BY id').fetchall()
+        assert [e['active'] for e in users] == [1, 1, 1]
+        assert [e['role'] for e in users] == [Roles.MODERATOR.value, Roles.MODERATOR.value, Roles.ADMIN.value]
+
+    response = client.get('/admin/user_cp')
+    assert b'activate: updated 2 of 2 selected user(s)' in response.data
+
 def test_user_edit(client, auth, app):
     auth.login(username='admin', password='b')
     response = client.get('/admin/user_edit/2')
@@ -272,3 +336,35 @@ def test_user_add(client, auth, app):
             )
     assert response.headers['Location'] == '/admin/user_cp'
 
+def test_user_add_edit_busy(client, auth, app):
+    auth.login(username='admin', password='b')
+    hasher = app.extensions['password_hasher']
+    hasher.workers = 1
+    hasher.timeout = 0
+    for _ in range(8):
+        hasher._pending.acquire()
+
+    data = {'username': 'busy_user', 'password': 'c', 'role': 'Roles.MEMBER'}
+    response = client.post('/admin/user_add', data=data)
+    assert response.headers['Location'] == '/admin/user_add'
+    response = client.post('/admin/user_edit/1', data={'password': 'c', 'confirm_new_password': 'c'})
+    assert response.headers['Location'] == '/admin/user_edit/1'
+    assert b'Too many people are logging in' in client.get('/admin/user_cp').data
+    with app.app_context():
+        assert get_db().execute("SELECT count(*) FROM user WHERE username = 'busy_user'").fetchone()[0] == 0
+
+
+def test_queries(client, auth, query_log):
+    auth.login(username='admin', password='b')
+    client.get('/')
+    response = client.get('/admin/queries')
+    assert b'Slowest Queries' in response.data
+    assert b'FROM post' in response.data
+
+    response = client.post('/admin/queries')
+    assert response.headers['Location'] == '/admin/queries'
+
+    # normal user has no access
+    auth.login()
+    response = client.get('/admin/queries')
+    assert response.headers['Location'] == '/'
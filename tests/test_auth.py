@@ -146,3 +146,41 @@ def test_last_login(auth, app):
                 ).fetchone()
         # add tzinfo to db data so direct equality comparison will work
         assert result['last_login'].replace(tzinfo=timezone.utc) == now
+
+def test_logged_in_user_cached(client, auth, app):
+    auth.login()
+    with client:
+        client.get('/')
+        user = g.user
+
+    # changes made behind the cache's back aren't seen until it expires
+    with app.app_context():
+        db = get_db()
+        db.execute("UPDATE user SET display_name = 'changed' WHERE id = 1")
+        db.commit()
+    with client:
+        client.get('/')
+        assert g.user is user
+        assert g.user.display_name is None
+
+        # static files skip the lookup
+        client.get('/static/style.css')
+        assert g.user is None
+
+    app.extensions['user_cache'].clear()
+    with client:
+        client.get('/')
+        assert g.user.display_name == 'changed'
+
+def test_user_cache_invalidated(client, auth, app):
+    auth.login()
+    with client:
+        client.get('/')
+        assert g.user.last_login is not None
+        user = g.user
+
+    # logging in again updates last_login, which drops the cached user
+    auth.login()
+    with client:
+        client.get('/')
+        assert g.user is not user
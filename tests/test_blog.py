@@ -13,10 +13,14 @@
 
 #You should have received a copy of the GNU Affero General Public License
 #along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import io
 import os
+import sqlite3
 import tempfile
 import pytest
 from doublecheck.db import get_db
+from doublecheck.pgn import decompress_pgn
+import doublecheck.blog
 
 def test_index(client, auth):
     response = client.get('/')
@@ -29,9 +33,117 @@ def test_index(client, auth):
     assert b'by test on 2018-01-01' in response.data
     assert b'test\nbody' in response.data
     assert b'href="/1/update"' in response.data
-    assert b'<svg' in response.data
+    # boards are linked, not inlined
+    assert b'<svg' not in response.data
+    # the test game has no stored final position, so it's linked by ply
+    assert b'<img src="/game/1/board/16.svg"' in response.data
+    assert b'loading="lazy"' in response.data
     assert b'href="/game/1/view"' in response.data
 
+def test_index_pagination(client, app):
+    app.config['POSTS_PER_PAGE'] = 1
+
+    # newest post first, with only a link to older posts
+    response = client.get('/')
+    assert b'<h1>test title 2</h1>' in response.data
+    assert b'<h1>test title</h1>' not in response.data
+    assert b'Newer posts' not in response.data
+    assert b'href="/?before=2018-01-01+00:00:00_2"' in response.data
+
+    # both posts share a created timestamp, so the id breaks the tie
+    response = client.get('/?before=2018-01-01+00:00:00_2')
+    assert b'<h1>test title</h1>' in response.data
+    assert b'<h1>test title 2</h1>' not in response.data
+    assert b'Older posts' not in response.data
+    assert b'href="/?after=2018-01-01+00:00:00_1"' in response.data
+
+    response = client.get('/?after=2018-01-01+00:00:00_1')
+    assert b'<h1>test title 2</h1>' in response.data
+    assert b'<h1>test title</h1>' not in response.data
+
+    assert client.get('/?before=garbage').status_code == 400
+
+def test_index_streamed(client, app, monkeypatch):
+    rendered = []
+    def get_board_url(post):
+        rendered.append(post.id)
+        return 'board'
+    monkeypatch.setattr('doublecheck.blog.get_board_url', get_board_url)
+
+    response = client.get('/')
+    try:
+        chunks = iter(response.response)
+        # the top of the page goes out before any post is read
+        body = b''
+        while b'<h1>Posts</h1>' not in body:
+            body += next(chunks)
+        assert rendered == []
+        body += b''.join(chunks)
+    finally:
+        response.close()
+    assert b'test title 2' in body
+    assert len(rendered) == 2
+
+    # and the same page comes out with streaming turned off
+    app.config['INDEX_STREAMING'] = False
+    assert client.get('/').data == body
+
+def test_index_not_modified(client, auth, app, monkeypatch):
+    response = client.get('/')
+    etag = response.headers['ETag']
+    # deletes leave no newer timestamp behind, so only the tag is used
+    assert 'Last-Modified' not in response.headers
+    assert 'no-cache' in response.headers['Cache-Control']
+
+    # an unchanged page is answered before any posts are read
+    def fail(*args, **kwargs):
+        raise AssertionError('page was built')
+    monkeypatch.setattr('doublecheck.blog.get_post_page', fail)
+    response = client.get('/', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.data == b''
+    monkeypatch.undo()
+
+    # a different page, or a different user, gets a different tag
+    assert client.get('/?before=2018-01-01+00:00:00_2').headers['ETag'] != etag
+    auth.login()
+    logged_in_etag = client.get('/').headers['ETag']
+    assert logged_in_etag != etag
+
+    # editing, adding or deleting a post changes it too
+    client.post('/1/update', data={'title': 'updated', 'body': ''})
+    response = client.get('/', headers={'If-None-Match': logged_in_etag})
+    assert response.status_code == 200
+    assert b'updated' in response.data
+    edited_etag = response.headers['ETag']
+    client.post('/1/delete')
+    assert client.get('/', headers={'If-None-Match': edited_etag}).status_code == 200
+
+    # as does renaming a post's author
+    auth.login(username='admin', password='b')
+    response = client.get('/')
+    admin_etag = response.headers['ETag']
+    # the index is streamed, so it has to be read to finish the request
+    response.get_data()
+    client.post('/admin/user_edit/2', data={'display_name': 'renamed'})
+    response = client.get('/', headers={'If-None-Match': admin_etag})
+    assert response.status_code == 200
+    assert b'by renamed' in response.data
+
+def test_index_with_flashes_not_cached(client, app):
+    etag = client.get('/').headers['ETag']
+    # the flash has to be shown, so the page is built even though nothing changed
+    client.get('/auth/register')
+    response = client.get('/', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert b'Registration is currently disabled' in response.data
+    assert 'ETag' not in response.headers
+
+    # showing the message clears it, streamed or not
+    response = client.get('/')
+    assert b'Registration is currently disabled' not in response.data
+    assert response.headers['ETag'] == etag
+
 @pytest.mark.parametrize('path', (
     '/create',
     '/1/update',
@@ -114,9 +226,25 @@ def test_create_with_pgn(client, auth, app, pgn_suffix, pgn_contents):
     # check to make sure file got inserted to db
     with app.app_context():
         db = get_db()
-        file = db.execute('SELECT * FROM file WHERE id = ?', (max_file_id+1,)).fetchone()
+        file = db.execute(
+                'SELECT f.file_name, f.content_id, gc.* FROM file f JOIN game_content gc ON (f.content_id = gc.id) WHERE f.id = ?',
+                (max_file_id+1,)
+                ).fetchone()
         assert pgn_suffix in file['file_name']
-        assert pgn_contents.decode(encoding='utf-8') in file['file_contents']
+        assert pgn_contents.decode(encoding='utf-8') in decompress_pgn(file['file_contents'])
+        # the file is stored compressed
+        assert db.execute('SELECT typeof(file_contents) FROM game_content WHERE id = ?', (file['content_id'],)).fetchone()[0] == 'blob'
+        # derived game data is stored at upload time
+        assert file['pgn_white'] == 'foo'
+        assert file['pgn_event'] == 'test event 2'
+        assert file['pgn_result'] == '0-1'
+        assert file['ply_count'] == 16
+        assert file['pgn_movetext'].startswith('1. e4 e5 2. d4 Nf6')
+        assert file['final_fen'] == 'r1bq2k1/pp1p1rpp/3b1n2/2pP4/3nPB2/2N5/PPP2PPP/R2QKB1R w KQ - 0 9'
+
+    # and the index shows it without reparsing
+    response = client.get('/')
+    assert b'foo\n            vs \n            bar' in response.data
 
 @pytest.mark.parametrize(('pgn_suffix', 'pgn_contents', 'error'), (
     ('not_a_pgn.png', b'[Event "test event 2"]\n[Site "test site 2"]\n[Date "2023.10.17"]\n[Round "4"]\n[White "foo"]\n[Black "bar"]\n[Result "0-1"]\n\n1. e4 e5 2. d4 Nf6 3. Nc3 Nc6 4. d5 Nd4 5. Nf3 c5 6. Nxe5 Bd6 7. Bf4 O-O { test comment } 8. Nxf7 Rxf7 0-1', b'must be .pgn'),
@@ -141,6 +269,124 @@ def test_create_with_bad_pgn(client, auth, pgn_suffix, pgn_contents, error):
     assert error in response.data
     os.unlink(pgn_path)
 
+def upload_pgn(client, pgn_contents, title='test with pgn'):
+    return client.post('/create',
+                data={'title': title, 'body': '', 'pgn_file': (io.BytesIO(pgn_contents), 'games.pgn')}
+                )
+
+def test_create_with_many_games(client, auth, app):
+    games = b'[White "foo"]\n[Black "bar"]\n\n1. e4 e5 *\n\n[White "bar"]\n[Black "foo"]\n\n1. d4 d5 2. c4 *\n'
+    auth.login()
+    response = upload_pgn(client, games, title='two games')
+    assert response.headers['Location'] == '/'
+
+    with app.app_context():
+        db = get_db()
+        post_id = db.execute("SELECT id FROM post WHERE title = 'two games'").fetchone()[0]
+        files = db.execute(
+                'SELECT f.id, f.file_name, gc.pgn_white, gc.ply_count FROM file f JOIN game_content gc ON (f.content_id = gc.id)'
+                ' WHERE f.post_id = ? ORDER BY f.id',
+                (post_id,)
+                ).fetchall()
+    # each game gets its own file row
+    assert [e['pgn_white'] for e in files] == ['foo', 'bar']
+    assert [e['ply_count'] for e in files] == [2, 3]
+    assert files[1]['file_name'] == 'games.pgn#2'
+
+    response = client.get('/')
+    assert b'(1 of 2 games)' in response.data
+    response = client.get(f"/game/{files[0]['id']}/view")
+    assert f'href="/game/{files[1]["id"]}/view">Next game'.encode() in response.data
+
+def test_create_with_byte_order_mark(client, auth, app):
+    auth.login()
+    response = upload_pgn(client, b'\xef\xbb\xbf[White "foo"]\n\n1. e4 e5 *\n', title='bom game')
+    assert response.headers['Location'] == '/'
+    with app.app_context():
+        white = get_db().execute(
+                'SELECT gc.pgn_white FROM post p JOIN file f ON (f.post_id = p.id) JOIN game_content gc ON (f.content_id = gc.id)'
+                " WHERE p.title = 'bom game'"
+                ).fetchone()[0]
+    assert white == 'foo'
+
+def test_create_parses_before_writing(client, auth, app, monkeypatch):
+    derive_game_data = doublecheck.blog.derive_game_data
+    derived = []
+    def counted_derive(ingested):
+        derived.append(ingested)
+        return derive_game_data(ingested)
+    save_uploaded_games = doublecheck.blog.save_uploaded_games
+    attempts = []
+    def locked_once(*args):
+        attempts.append(args)
+        if len(attempts) == 1:
+            raise sqlite3.OperationalError('database is locked')
+        save_uploaded_games(*args)
+    monkeypatch.setattr('doublecheck.blog.save_uploaded_games', locked_once)
+    monkeypatch.setattr('doublecheck.blog.derive_game_data', counted_derive)
+
+    auth.login()
+    response = upload_pgn(client, b'[White "a"]\n\n1. e4 e5 *\n\n[White "b"]\n\n1. d4 d5 *\n', title='retried')
+    assert response.headers['Location'] == '/'
+    # the write was retried, but the games were only parsed once
+    assert len(attempts) == 2
+    assert len(derived) == 2
+    with app.app_context():
+        assert get_db().execute("SELECT count(*) FROM post WHERE title = 'retried'").fetchone()[0] == 1
+
+def test_create_normalizes_pgn(client, auth, app):
+    messy = b'[White "foo"]\r\n[Event "casual"]\r\n\r\n1.e4   e5\r\n2.Nf3 {a comment} Nc6  *\r\n'
+    auth.login()
+    upload_pgn(client, messy, title='messy game')
+
+    with app.app_context():
+        file = get_db().execute(
+                "SELECT gc.file_contents FROM file f JOIN post p ON (f.post_id = p.id) JOIN game_content gc ON (f.content_id = gc.id)"
+                " WHERE p.title = 'messy game'"
+                ).fetchone()
+    # stored as canonical pgn: seven tag roster in order, movetext on one line
+    assert decompress_pgn(file['file_contents']) == (
+            '[Event "casual"]\n[Site "?"]\n[Date "????.??.??"]\n[Round "?"]\n[White "foo"]\n[Black "?"]\n[Result "*"]\n\n'
+            '1. e4 e5 2. Nf3 { a comment } 2... Nc6 *'
+            )
+
+def test_create_dedupes_games(client, auth, app):
+    auth.login()
+    upload_pgn(client, b'[White "foo"]\n[Black "bar"]\n\n1. e4 e5 2. Nf3 *', title='first upload')
+    # the same game with annotations and different formatting
+    upload_pgn(client, b'[Black "bar"]\n[White "foo"]\n\n1. e4 { best by test } e5\n2. Nf3 (2. f4) *', title='second upload')
+    # a different game
+    upload_pgn(client, b'[White "foo"]\n[Black "bar"]\n\n1. e4 e5 2. Nc3 *', title='third upload')
+
+    # the same game again, formatted differently
+    upload_pgn(client, b'[White "foo"]\n[Black "bar"]\n\n1. e4 e5\n2. Nf3 *', title='fourth upload')
+
+    with app.app_context():
+        db = get_db()
+        files = db.execute('SELECT id, content_id, file_contents FROM file WHERE id > 1 ORDER BY id').fetchall()
+        content_ids = [e['content_id'] for e in files]
+        assert content_ids[0] == content_ids[1] == content_ids[3]
+        assert content_ids[2] != content_ids[0]
+        assert db.execute('SELECT count(*) FROM game_content').fetchone()[0] == 3
+        # the annotated copy keeps its own text, the others use the shared one
+        assert [e['file_contents'] is None for e in files] == [True, False, True, True]
+
+    # each file shows its own annotations
+    assert b'best by test' not in client.get(f'/game/{files[0]["id"]}/view').data
+    assert b'best by test' in client.get(f'/game/{files[1]["id"]}/view').data
+
+def test_create_with_bad_game_in_many(client, auth, app):
+    games = b'1. e4 e5 *\n\n[White "broken"]\n\n1. e4 e5 2. Qxf7 *\n'
+    auth.login()
+    response = upload_pgn(client, games, title='one bad game')
+    assert b'Game 2: Invalid PGN: errors encountered while parsing' in response.data
+
+    # nothing from the failed upload is kept
+    with app.app_context():
+        db = get_db()
+        assert db.execute("SELECT count(*) FROM post WHERE title = 'one bad game'").fetchone()[0] == 0
+        assert db.execute('SELECT count(*) FROM file').fetchone()[0] == 1
+
 def test_update(client, auth, app):
     auth.login()
     assert client.get('/1/update').status_code == 200
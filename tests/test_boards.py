@@ -0,0 +1,61 @@
+#Doublecheck - A web-based chess game database.
+#Copyright (C) 2024 Nick Edner
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU Affero General Public License as published
+#by the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU Affero General Public License for more details.
+
+#You should have received a copy of the GNU Affero General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import os
+
+import chess
+from doublecheck.boards import BoardCache, get_board_cache
+
+def test_memory_cache():
+    cache = BoardCache(2)
+    svg = cache.render(chess.STARTING_FEN)
+    assert '<svg' in svg
+    assert cache.render(chess.STARTING_FEN) is svg
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 1
+
+    # size, orientation and lastmove are all part of the key
+    cache.render(chess.STARTING_FEN, size=100)
+    cache.render(chess.STARTING_FEN, orientation=chess.BLACK)
+    assert cache.stats()['misses'] == 3
+    # and the cache stays bounded
+    assert cache.stats()['size'] == 2
+
+def test_disk_cache(tmp_path):
+    directory = tmp_path / 'boards'
+    cache = BoardCache(16, directory=str(directory))
+    # the directory is made when the first board is written
+    assert not directory.exists()
+    svg = cache.render(chess.STARTING_FEN, lastmove='e2e4')
+    assert cache.stats()['disk_misses'] == 1
+
+    # a fresh cache (e.g. in another worker) picks up the rendered file
+    other_cache = BoardCache(16, directory=str(directory))
+    assert other_cache.render(chess.STARTING_FEN, lastmove=chess.Move.from_uci('e2e4')) == svg
+    assert other_cache.stats()['disk_hits'] == 1
+    assert not any(name.endswith('.tmp') for _, _, files in os.walk(tmp_path) for name in files)
+
+def test_board_image_uses_cache(client, app):
+    client.get('/game/1/board/16.svg')
+    client.get('/game/1/board/16.svg')
+    with app.app_context():
+        stats = get_board_cache().stats()
+    assert stats['misses'] == 1
+    assert stats['hits'] == 1
+
+def test_admin_stats(client, auth):
+    auth.login(username='admin', password='b')
+    response = client.get('/admin/')
+    assert b'Board Image Cache' in response.data
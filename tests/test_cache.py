@@ -0,0 +1,28 @@
+#Doublecheck - A web-based chess game database.
+#Copyright (C) 2024 Nick Edner
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU Affero General Public License as published
+#by the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU Affero General Public License for more details.
+
+#You should have received a copy of the GNU Affero General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from doublecheck.cache import LRUCache
+
+def test_cache_ttl(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr('doublecheck.cache.time.monotonic', lambda: now[0])
+    cache = LRUCache(2, ttl=30)
+    cache.put('a', 1)
+    now[0] += 29
+    assert cache.get('a') == 1
+    now[0] += 1
+    assert cache.get('a') is None
+    assert len(cache) == 0
+    assert cache.stats()['misses'] == 1
@@ -13,12 +13,16 @@
 
 #You should have received a copy of the GNU Affero General Public License
 #along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import itertools
 import sqlite3
+import threading
 
 import pytest
-from doublecheck.db import get_db
+from doublecheck.db import get_db, run_write
+from doublecheck.pgn import decompress_pgn, game_hash, read_game
 
 def test_get_close_db(app):
+    app.config['DATABASE_PERSISTENT_CONNECTIONS'] = False
     with app.app_context():
         db = get_db()
         assert db is get_db()
@@ -28,6 +32,106 @@ def test_get_close_db(app):
 
     assert 'closed' in str(e.value)
 
+def test_persistent_connections(app):
+    with app.app_context():
+        db = get_db()
+        assert db is get_db()
+        # pragmas from config are applied to new connections
+        assert db.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+        assert db.execute('PRAGMA synchronous').fetchone()[0] == 1
+        assert db.execute('PRAGMA busy_timeout').fetchone()[0] == 5000
+        # leave a transaction open at the end of the context
+        db.execute("UPDATE post SET title = 'uncommitted' WHERE id = 1")
+
+    # the same thread gets the same connection back, minus the open transaction
+    with app.app_context():
+        assert get_db() is db
+        assert not db.in_transaction
+        assert db.execute('SELECT title FROM post WHERE id = 1').fetchone()[0] == 'test title'
+        db.close()
+
+    # a connection which stopped working is replaced on checkout
+    with app.app_context():
+        new_db = get_db()
+        assert new_db is not db
+        assert new_db.execute('SELECT 1').fetchone()[0] == 1
+
+def test_connections_per_thread(app):
+    with app.app_context():
+        db = get_db()
+
+    other = []
+    def other_thread():
+        with app.app_context():
+            other.append(get_db())
+    thread = threading.Thread(target=other_thread)
+    thread.start()
+    thread.join()
+    assert other[0] is not db
+
+@pytest.mark.parametrize('persistent', (True, False))
+def test_read_only_requests(app, persistent):
+    app.config['DATABASE_PERSISTENT_CONNECTIONS'] = persistent
+    # GET requests read through a connection which can't write
+    with app.test_request_context('/', method='GET'):
+        db = get_db()
+        assert db.execute('SELECT title FROM post WHERE id = 1').fetchone()[0] == 'test title'
+        with pytest.raises(sqlite3.OperationalError) as e:
+            db.execute("UPDATE post SET title = 'read only' WHERE id = 1")
+        assert 'readonly' in str(e.value)
+        # unless they ask for the writer
+        writer = get_db(write=True)
+        assert writer is not db
+        writer.execute("UPDATE post SET title = 'written' WHERE id = 1")
+        writer.commit()
+
+    # everything else gets the writer
+    with app.test_request_context('/create', method='POST'):
+        get_db().execute("UPDATE post SET title = 'posted' WHERE id = 1")
+    with app.app_context():
+        assert get_db().execute('SELECT title FROM post WHERE id = 1').fetchone()[0] == 'written'
+
+def test_run_write(app):
+    with app.app_context():
+        def insert_post(db):
+            return db.execute("INSERT INTO post (title, body, author_id) VALUES ('new', '', 1)").lastrowid
+        post_id = run_write(insert_post)
+        assert get_db().execute('SELECT title FROM post WHERE id = ?', (post_id,)).fetchone()[0] == 'new'
+
+        # anything raised rolls back everything the write did
+        def fail_halfway(db):
+            insert_post(db)
+            raise ValueError('halfway')
+        with pytest.raises(ValueError):
+            run_write(fail_halfway)
+        assert get_db().execute('SELECT count(*) FROM post').fetchone()[0] == 3
+
+@pytest.mark.parametrize('writer_thread', (True, False))
+def test_run_write_retries_when_locked(app, writer_thread):
+    app.config['DATABASE_WRITER_THREAD'] = writer_thread
+    app.config['DATABASE_WRITE_BACKOFF'] = 0
+    app.config['DATABASE_WRITE_RETRIES'] = 2
+    with app.app_context():
+        attempts = []
+        def locked_twice(db):
+            attempts.append(threading.current_thread())
+            if len(attempts) < 3:
+                raise sqlite3.OperationalError('database is locked')
+            db.execute("UPDATE post SET title = 'retried' WHERE id = 1")
+        run_write(locked_twice)
+        assert len(attempts) == 3
+        assert (attempts[0] is threading.current_thread()) != writer_thread
+        assert get_db().execute('SELECT title FROM post WHERE id = 1').fetchone()[0] == 'retried'
+
+        # the retries are bounded
+        attempts.clear()
+        def always_locked(db):
+            attempts.append(threading.current_thread())
+            raise sqlite3.OperationalError('database is locked')
+        with pytest.raises(sqlite3.OperationalError):
+            run_write(always_locked)
+        assert len(attempts) == 3
+
 def test_init_db_command(runner, monkeypatch):
     class Recorder(object):
         called = False
@@ -39,3 +143,257 @@ def test_init_db_command(runner, monkeypatch):
     result = runner.invoke(args=['init-db'])
     assert 'Initialized' in result.output
     assert Recorder.called
+
+def test_refresh_game_data_command(runner, app):
+    result = runner.invoke(args=['refresh-game-data'])
+    assert 'Refreshed game data for 1 file(s)' in result.output
+
+    with app.app_context():
+        content = get_db().execute('SELECT * FROM game_content WHERE id = 1').fetchone()
+        assert content['final_fen'] is not None
+        assert content['ply_count'] == 16
+        assert len(content['moves']) == 32
+
+    # nothing left to refresh the second time around
+    result = runner.invoke(args=['refresh-game-data'])
+    assert 'Refreshed game data for 0 file(s)' in result.output
+
+def test_compress_files_command(runner, app, client):
+    with app.app_context():
+        db = get_db()
+        assert db.execute('SELECT typeof(file_contents) FROM game_content WHERE id = 1').fetchone()[0] == 'text'
+        original = db.execute('SELECT file_contents FROM game_content WHERE id = 1').fetchone()[0]
+
+    result = runner.invoke(args=['compress-files'])
+    assert 'Compressed 1 file(s)' in result.output
+
+    with app.app_context():
+        db = get_db()
+        assert db.execute('SELECT typeof(file_contents) FROM game_content WHERE id = 1').fetchone()[0] == 'blob'
+        # and decompresses back to the original text
+        assert decompress_pgn(db.execute('SELECT file_contents FROM game_content WHERE id = 1').fetchone()[0]) == original
+    # everything reading the file decompresses it, whatever the column is declared as
+    assert b'/game/1/board/16.svg' in client.get('/').get_data()
+    assert b'8... Rxf7' in client.post('/game/1/view', data={'lastMove': 'true'}).data
+
+    result = runner.invoke(args=['compress-files'])
+    assert 'Compressed 0 file(s)' in result.output
+
+def test_dedupe_games_command(runner, app):
+    # stage a second copy of the legacy game, and a third with another
+    #   comment, under different hashes
+    with app.app_context():
+        db = get_db()
+        db.execute("INSERT INTO game_content (content_hash, file_contents) SELECT 'legacy-2', file_contents FROM game_content WHERE id = 1")
+        db.execute("INSERT INTO game_content (content_hash, file_contents)"
+                   " SELECT 'legacy-3', replace(file_contents, 'test comment', 'other comment') FROM game_content WHERE id = 1")
+        db.execute("INSERT INTO file (uploader_id, post_id, file_name, content_id) VALUES (1, 1, 'copy.pgn', 2), (1, 1, 'other.pgn', 3)")
+        db.commit()
+
+    result = runner.invoke(args=['dedupe-games'])
+    assert 'Merged 2 duplicate game(s)' in result.output
+
+    with app.app_context():
+        db = get_db()
+        assert db.execute('SELECT count(*) FROM game_content').fetchone()[0] == 1
+        # all the files now point at the copy that was kept
+        files = db.execute('SELECT content_id, file_contents FROM file ORDER BY id').fetchall()
+        assert [e['content_id'] for e in files] == [1, 1, 1]
+        assert db.execute('SELECT content_hash FROM game_content').fetchone()[0] == 'cabba13f9957956e13506b983f2377be7a101098e46170506f1e16649f332b54'
+        # and only the one with other annotations keeps its own text
+        assert files[0]['file_contents'] is None
+        assert files[1]['file_contents'] is None
+        assert 'other comment' in decompress_pgn(files[2]['file_contents'])
+
+    result = runner.invoke(args=['dedupe-games'])
+    assert 'Merged 0 duplicate game(s)' in result.output
+
+# the tables as the first release created them, with each game stored in file
+BASELINE_SCHEMA = '''
+CREATE TABLE user (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  username TEXT UNIQUE NOT NULL,
+  password TEXT NOT NULL,
+  role INTEGER NOT NULL,
+  created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  active INTEGER NOT NULL DEFAULT 1,
+  deactivated_on TIMESTAMP NULL,
+  display_name TEXT NULL,
+  member_number TEXT NULL,
+  last_login TIMESTAMP NULL,
+  timezone INTEGER NULL
+);
+
+CREATE TABLE post (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  author_id INTEGER NOT NULL,
+  created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  edited TIMESTAMP NULL,
+  visibility INTEGER NULL,
+  title TEXT NOT NULL,
+  body TEXT NOT NULL,
+  FOREIGN KEY (author_id) REFERENCES user (id)
+);
+
+CREATE TABLE file (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  uploader_id INTEGER NOT NULL,
+  post_id INTEGER NOT NULL,
+  created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  file_name TEXT NOT NULL,
+  file_contents TEXT NOT NULL,
+  FOREIGN KEY (uploader_id) REFERENCES user (id),
+  FOREIGN KEY (post_id) REFERENCES post (id)
+);
+'''
+
+def test_migrate_db_command(app_with_no_data):
+    app = app_with_no_data
+    game = '[White "foo"]\n[Black "bar"]\n\n1. e4 e5 2. Nf3 *'
+    annotated = '[White "foo"]\n[Black "bar"]\n\n1. e4 { best by test } e5 2. Nf3 *'
+    other = '[White "bar"]\n[Black "foo"]\n\n1. d4 d5 *'
+    with app.app_context():
+        db = get_db()
+        for table in [e[0] for e in db.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name != 'sqlite_sequence'")]:
+            db.execute(f'DROP TABLE {table}')
+        db.executescript(BASELINE_SCHEMA)
+        db.execute("INSERT INTO user (username, password, role) VALUES ('test', 'x', 3)")
+        db.executemany("INSERT INTO post (title, body, author_id) VALUES (?, '', 1)", [(f'post {e}',) for e in range(4)])
+        db.executemany("INSERT INTO file (uploader_id, post_id, file_name, file_contents) VALUES (1, ?, 'game.pgn', ?)",
+                       [(1, game), (2, annotated), (3, game), (4, other)])
+        db.commit()
+
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=['migrate-db'])
+    assert 'Moved 4 game file(s)' in result.output
+
+    with app.app_context():
+        db = get_db()
+        files = db.execute('SELECT id, post_id, content_id, file_contents FROM file ORDER BY id').fetchall()
+        assert [e['post_id'] for e in files] == [1, 2, 3, 4]
+        # copies of a game share its content, and only the annotated one keeps
+        #   its own text
+        content_ids = [e['content_id'] for e in files]
+        assert content_ids[0] == content_ids[1] == content_ids[2] != content_ids[3]
+        assert [e['file_contents'] for e in files] == [None, annotated, None, None]
+        contents = db.execute('SELECT content_hash, file_contents FROM game_content ORDER BY id').fetchall()
+        assert [tuple(e) for e in contents] == [(game_hash(read_game(game)), game), (game_hash(read_game(other)), other)]
+        assert db.execute('SELECT version FROM setting_version').fetchone()[0] == 0
+        assert db.execute('SELECT count(*) FROM post_version').fetchone()[0] == 1
+
+    # the migrated games can be listed and viewed before they're refreshed
+    client = app.test_client()
+    assert b'/game/4/board/2.svg' in client.get('/').get_data()
+    assert b'best by test' in client.get('/game/2/view').data
+
+    # a second run finds nothing to do
+    result = runner.invoke(args=['migrate-db'])
+    assert result.output == 'Migrated the database.\n'
+    result = runner.invoke(args=['refresh-game-data'])
+    assert 'Refreshed game data for 2 file(s)' in result.output
+    result = runner.invoke(args=['compress-files'])
+    assert 'Compressed 3 file(s)' in result.output
+
+    # and the index's tag changes with the posts, through the new triggers
+    etag = client.get('/').headers['ETag']
+    with app.app_context():
+        db = get_db()
+        db.execute("UPDATE post SET title = 'changed' WHERE id = 1")
+        db.commit()
+    assert client.get('/').headers['ETag'] != etag
+
+PGN_ARCHIVE = '''[Event "club champs"]
+[White "foo"]
+[Black "bar"]
+[Result "1-0"]
+
+1. e4 e5 2. Qh5 Nc6 3. Bc4 Nf6 4. Qxf7# 1-0
+
+[Event "club champs"]
+[White "bar"]
+[Black "foo"]
+[Result "0-1"]
+
+1. f3 e5 2. g4 Qh4# 0-1
+
+[Event "club champs"]
+[White "broken"]
+[Black "game"]
+[Result "*"]
+
+1. e4 e5 2. Qxf7 *
+
+[Event "club champs"]
+[White "baz"]
+[Black "foo"]
+[Result "1/2-1/2"]
+
+1. d4 { a comment
+spanning lines } d5 1/2-1/2
+'''
+
+@pytest.mark.parametrize('workers', ('0', '2'))
+def test_import_pgn_command(runner, app, tmp_path, workers):
+    path = tmp_path / 'archive.pgn'
+    path.write_text(PGN_ARCHIVE)
+
+    result = runner.invoke(args=['import-pgn', str(path), '--author', 'test', '--batch-size', '2', '--workers', workers])
+    assert 'games/s' in result.output
+    assert 'Imported 3 of 4 games' in result.output
+
+    with app.app_context():
+        db = get_db()
+        posts = db.execute(
+                'SELECT p.title, gc.pgn_white, gc.ply_count FROM post p JOIN file f ON (f.post_id = p.id)'
+                ' JOIN game_content gc ON (f.content_id = gc.id)'
+                ' WHERE p.author_id = 1 ORDER BY p.id'
+                ).fetchall()
+        assert [e['title'] for e in posts] == ['foo vs bar, club champs', 'bar vs foo, club champs', 'baz vs foo, club champs']
+        assert posts[-1]['ply_count'] == 2
+
+    # running it again resumes after the last saved batch, so nothing is imported twice
+    result = runner.invoke(args=['import-pgn', str(path), '--author', 'test', '--workers', workers])
+    assert 'Imported 3 of 4 games' in result.output
+    with app.app_context():
+        assert get_db().execute('SELECT count(*) FROM file').fetchone()[0] == 4
+
+def test_import_pgn_rate(runner, tmp_path, monkeypatch):
+    path = tmp_path / 'archive.pgn'
+    path.write_text(PGN_ARCHIVE)
+    # a clock that moves on a second each time it's read
+    clock = itertools.count()
+    monkeypatch.setattr('doublecheck.db.time.monotonic', lambda: next(clock))
+    result = runner.invoke(args=['import-pgn', str(path), '--author', 'test', '--batch-size', '2', '--workers', '0'])
+    # the rate counts from the start of the import, including the first batch
+    assert '2 games read, 2 imported (2.0 games/s)' in result.output
+    assert '4 games read, 3 imported (2.0 games/s)' in result.output
+
+def test_import_pgn_resume(runner, app, tmp_path, monkeypatch):
+    path = tmp_path / 'archive.pgn'
+    path.write_text(PGN_ARCHIVE)
+
+    # interrupt the import after the first batch is saved
+    import doublecheck.db
+    parse_game_chunk = doublecheck.db.parse_game_chunk
+    calls = []
+    def flaky_parse(chunk):
+        calls.append(chunk)
+        if len(calls) > 2:
+            raise KeyboardInterrupt()
+        return parse_game_chunk(chunk)
+    monkeypatch.setattr('doublecheck.db.parse_game_chunk', flaky_parse)
+    runner.invoke(args=['import-pgn', str(path), '--author', 'test', '--batch-size', '2', '--workers', '0'])
+    with app.app_context():
+        assert get_db().execute('SELECT games_read FROM pgn_import').fetchone()[0] == 2
+
+    monkeypatch.setattr('doublecheck.db.parse_game_chunk', parse_game_chunk)
+    result = runner.invoke(args=['import-pgn', str(path), '--author', 'test', '--workers', '0'])
+    assert 'Imported 3 of 4 games' in result.output
+    with app.app_context():
+        assert get_db().execute('SELECT count(*) FROM file').fetchone()[0] == 4
+
+def test_import_pgn_unknown_author(runner, tmp_path):
+    path = tmp_path / 'archive.pgn'
+    path.write_text(PGN_ARCHIVE)
+    result = runner.invoke(args=['import-pgn', str(path), '--author', 'nobody'])
+    assert 'User nobody does not exist' in result.output
@@ -13,7 +13,10 @@
 
 #You should have received a copy of the GNU Affero General Public License
 #along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import io
+
 from doublecheck.db import get_db
+from doublecheck.game import get_game_view_data
 
 def test_index(client):
     assert client.get('/game/').status_code == 404
@@ -52,3 +55,129 @@ def test_view_buttons(client):
     response = client.post('/game/1/view', data={'nonExistentMove': 'true'})
     assert response.status_code == 200
     assert b'Nxe5' in response.data
+
+def test_view_not_modified(client, app, monkeypatch):
+    response = client.get('/game/1/view')
+    etag = response.headers['ETag']
+
+    # the game isn't read again for an unchanged page
+    def fail(*args, **kwargs):
+        raise AssertionError('game was read')
+    monkeypatch.setattr('doublecheck.game.get_game_view_data', fail)
+    response = client.get('/game/1/view', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    monkeypatch.undo()
+
+    # moving to another ply changes the page
+    client.post('/game/1/view', data={'nextMove': 'true'})
+    response = client.get('/game/1/view', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+
+    assert client.get('/game/99/view', headers={'If-None-Match': etag}).status_code == 404
+
+def test_view_jump_to_ply(client):
+    response = client.post('/game/1/view', data={'ply': '15'})
+    assert b'Turn <span id="game-ply">15</span>' in response.data
+    assert b'8. Nxf7 Rxf7' in response.data
+    response = client.post('/game/1/view', data={'ply': '16'})
+    assert b'8... Rxf7' in response.data
+    # jumping past the end stops at the last move
+    response = client.post('/game/1/view', data={'ply': '99'})
+    assert b'Turn <span id="game-ply">16</span>' in response.data
+    response = client.post('/game/1/view', data={'nextMove': 'true'})
+    assert b'Turn <span id="game-ply">16</span>' in response.data
+
+def test_moves_saved_on_view(client, app):
+    with app.app_context():
+        assert get_db().execute('SELECT moves FROM game_content WHERE id = 1').fetchone()['moves'] is None
+    response = client.get('/game/1/positions.json')
+    assert len(response.get_json()['positions']) == 17
+    # games stored before their moves were get them on first view
+    with app.app_context():
+        content = get_db().execute('SELECT start_fen, moves FROM game_content WHERE id = 1').fetchone()
+    assert content['start_fen'] is None
+    assert len(content['moves']) == 32
+
+def test_positions_json(client):
+    response = client.get('/game/1/positions.json')
+    assert response.status_code == 200
+    assert response.headers['Cache-Control'] == 'public, max-age=86400'
+    data = response.get_json()
+    assert data['id'] == 1
+    assert len(data['positions']) == 17
+    assert data['positions'][1]['san'] == 'e4'
+    assert data['positions'][16]['uci'] == 'f8f7'
+
+    # revalidating an unchanged game is a 304 with no body
+    etag = response.headers['ETag']
+    response = client.get('/game/1/positions.json', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.data == b''
+
+    assert client.get('/game/99/positions.json').status_code == 404
+
+def test_board_svg(client, app):
+    response = client.get('/game/1/board/16.svg')
+    assert response.status_code == 200
+    assert response.mimetype == 'image/svg+xml'
+    assert b'<svg' in response.data
+    assert response.headers['Cache-Control'] == 'public, max-age=31536000, immutable'
+
+    etag = response.headers['ETag']
+    assert client.get('/game/1/board/16.svg', headers={'If-None-Match': etag}).status_code == 304
+    assert client.get('/game/1/board/17.svg').status_code == 404
+    assert client.get('/game/99/board/0.svg').status_code == 404
+
+    # the same pieces from a fen give the same image, but only for boards
+    #   which end a stored game
+    with app.app_context():
+        positions = get_game_view_data(1)['positions']
+        placement = positions[16].fen.split(' ')[0]
+        assert client.get(f'/game/board/{placement}.svg').status_code == 404
+        db = get_db()
+        db.execute('UPDATE game_content SET final_fen = ? WHERE id = 1', (positions[16].fen,))
+        db.commit()
+    response = client.get(f'/game/board/{placement}.svg')
+    assert response.status_code == 200
+    assert response.headers['ETag'] == etag
+    assert client.get(f"/game/board/{positions[15].fen.split(' ')[0]}.svg").status_code == 404
+    assert client.get('/game/board/rnbqkbnr/pppppppp/8.svg').status_code == 404
+
+def test_view_board_image(client):
+    response = client.post('/game/1/view', data={'ply': '3'})
+    assert b'<img src="/game/1/board/3.svg"' in response.data
+    assert b'loading="lazy"' in response.data
+
+def test_view_shows_annotations(client, auth):
+    auth.login()
+    pgn = b'[Event "annotated"]\n\n1. e4 { best by test } e5 (1... c5 2. Nf3) 2. Nf3 $1 Nc6 *'
+    client.post('/create', data={'title': 'annotated', 'body': '', 'pgn_file': (io.BytesIO(pgn), 'game.pgn')})
+
+    response = client.get('/game/2/view')
+    assert b'{ best by test }' in response.data
+    assert b'( 1... c5 2. Nf3 )' in response.data
+    assert b'[Event &#34;annotated&#34;]' in response.data
+    # the comment stays on the page as the game is stepped through, so the
+    #   bare move list in the browser isn't used
+    assert b'game_view.js' not in response.data
+    response = client.post('/game/2/view', data={'nextMove': 'true'})
+    assert b'1. e4 { best by test } 1... e5' in response.data
+    response = client.post('/game/2/view', data={'nextMove': 'true'})
+    assert b'2. Nf3 $1' in response.data
+
+def test_view_client_stepping(client, auth, app):
+    auth.login()
+    client.post('/create', data={'title': 'plain', 'body': '', 'pgn_file': (io.BytesIO(b'1. d4 d5 2. c4 *'), 'game.pgn')})
+    response = client.get('/game/2/view')
+    assert b'data-positions-url="/game/2/positions.json"' in response.data
+    assert b'game_view.js' in response.data
+
+    # the test game has a comment, which only the server shows
+    response = client.get('/game/1/view')
+    assert b'{ test comment }' in response.data
+    assert b'game_view.js' not in response.data
+
+    app.config['GAME_VIEW_CLIENT_STEPPING'] = False
+    response = client.get('/game/2/view')
+    assert b'game_view.js' not in response.data
@@ -0,0 +1,49 @@
+#Doublecheck - A web-based chess game database.
+#Copyright (C) 2024 Nick Edner
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU Affero General Public License as published
+#by the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU Affero General Public License for more details.
+
+#You should have received a copy of the GNU Affero General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import pytest
+
+from doublecheck.db import get_db
+from doublecheck.models import GameFile, Post, User
+
+def test_user(app):
+    with app.app_context():
+        row = get_db().execute(f'SELECT {User.columns()} FROM user WHERE username = ?', ('test',)).fetchone()
+        user = User.from_row(row)
+    assert user.username == 'test'
+    # rows can still be read like sqlite3.Row
+    assert user['id'] == user.id
+    with pytest.raises(KeyError):
+        user['password']
+    # slotted, so no per-instance dict
+    assert not hasattr(user, '__dict__')
+
+def test_post_listing(app):
+    with app.app_context():
+        rows = get_db().execute(
+                f'SELECT {Post.listing_columns()}'
+                ' FROM post p JOIN user u ON (p.author_id = u.id)'
+                ' LEFT JOIN file f ON (f.id = (SELECT min(id) FROM file WHERE post_id = p.id))'
+                ' LEFT JOIN game_content gc ON (f.content_id = gc.id)'
+                ' ORDER BY p.id'
+                ).fetchall()
+        posts = [Post.from_row(e) for e in rows]
+    assert posts[0].title == 'test title'
+    assert posts[0].username == 'test'
+    assert posts[0].game is None
+    assert posts[0].game_count == 0
+    assert isinstance(posts[1].game, GameFile)
+    assert posts[1].game.file_name == 'test_file.pgn'
+    assert posts[1].game_count == 1
@@ -0,0 +1,70 @@
+#Doublecheck - A web-based chess game database.
+#Copyright (C) 2024 Nick Edner
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU Affero General Public License as published
+#by the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU Affero General Public License for more details.
+
+#You should have received a copy of the GNU Affero General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import pytest
+
+from doublecheck.db import get_db
+from doublecheck.passwords import PasswordHasher, PasswordHasherBusy
+
+def test_hasher_pool():
+    hasher = PasswordHasher('pbkdf2:sha256:1000', workers=1)
+    try:
+        pwhash = hasher.hash('secret')
+        assert pwhash.startswith('pbkdf2:sha256:1000$')
+        assert hasher.check(pwhash, 'secret')
+        assert not hasher.check(pwhash, 'wrong')
+    finally:
+        hasher.shutdown()
+
+def test_hasher_busy():
+    hasher = PasswordHasher('pbkdf2:sha256:1000', workers=1, max_pending=1, timeout=0)
+    # take the only slot, as if another login was being checked
+    hasher._pending.acquire()
+    with pytest.raises(PasswordHasherBusy):
+        hasher.hash('secret')
+    hasher._pending.release()
+
+def test_needs_rehash():
+    hasher = PasswordHasher('scrypt:32768:8:1', workers=0)
+    assert not hasher.needs_rehash('scrypt:32768:8:1$salt$hash')
+    assert hasher.needs_rehash('scrypt:16384:8:1$salt$hash')
+    assert hasher.needs_rehash('pbkdf2:sha256:50000$salt$hash')
+
+    # a method written without its parameters means werkzeug's defaults
+    hasher = PasswordHasher('scrypt', workers=0)
+    assert not hasher.needs_rehash(hasher.hash('secret'))
+    hasher.method = 'pbkdf2:sha256:1000'
+    assert hasher.needs_rehash('scrypt:32768:8:1$salt$hash')
+    assert not hasher.needs_rehash(hasher.hash('secret'))
+
+def test_rehash_on_login(app, auth):
+    app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:1000'
+    app.extensions['password_hasher'].method = 'pbkdf2:sha256:1000'
+    assert auth.login().headers['Location'] == '/'
+    with app.app_context():
+        pwhash = get_db().execute('SELECT password FROM user WHERE id = 1').fetchone()[0]
+    assert pwhash.startswith('pbkdf2:sha256:1000$')
+    # and the new hash still logs in
+    auth.logout()
+    assert auth.login().headers['Location'] == '/'
+
+def test_login_busy(app, auth):
+    hasher = app.extensions['password_hasher']
+    hasher.workers = 1
+    hasher.timeout = 0
+    for _ in range(8):
+        hasher._pending.acquire()
+    response = auth.login()
+    assert b'Too many people are logging in' in response.data
@@ -0,0 +1,117 @@
+#Doublecheck - A web-based chess game database.
+#Copyright (C) 2024 Nick Edner
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU Affero General Public License as published
+#by the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU Affero General Public License for more details.
+
+#You should have received a copy of the GNU Affero General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import io
+
+import chess
+import pytest
+from doublecheck.db import get_db
+from doublecheck.pgn import (
+        StagedGames, decode_moves, derive_game_data, encode_moves, ingest_pgn, iter_pgn_chunks, read_game,
+        read_header_summary, read_summary, replay_positions, summarize_game
+        )
+
+def test_encode_moves_round_trip():
+    moves = [chess.Move.from_uci(e) for e in ('e1g1', 'a7a8q', 'b2b1n', 'h7h8r', 'c7c8b')] + [chess.Move.null()]
+    encoded = encode_moves(moves)
+    # two bytes per move
+    assert len(encoded) == 12
+    assert decode_moves(encoded) == moves
+
+def test_replay_positions():
+    game = read_game('1. e4 e5 2. Nf3 { comment } Nc6 (2... d6) 3. Bb5 a6 4. Ba4 Nf6 5. O-O *')
+    positions = replay_positions(None, encode_moves(game.mainline_moves()))
+    assert [e.fen for e in positions] == [game.board().fen()] + [e.board().fen() for e in game.mainline()]
+    assert [e.san for e in positions] == [None] + [e.san() for e in game.mainline()]
+    assert [e.ply for e in positions] == list(range(10))
+    assert positions[0].lastmove is None
+    assert positions[9].lastmove.uci() == 'e1g1'
+
+    # games set up from a position replay from there
+    fen = '8/P3k3/8/8/8/8/8/4K3 w - - 0 1'
+    game = read_game(f'[FEN "{fen}"]\n[SetUp "1"]\n\n1. a8=Q Kd6 *')
+    positions = replay_positions(fen, encode_moves(game.mainline_moves()))
+    assert [e.fen for e in positions] == [game.board().fen()] + [e.board().fen() for e in game.mainline()]
+    assert positions[1].san == 'a8=Q'
+
+@pytest.mark.parametrize('pgn', (
+    '[White "a"]\n[Black "b"]\n[Result "1-0"]\n\n1. e4 { comment } e5 (1... c5 2. Nf3) 2. Nf3 $1 Nc6 3. Bb5 1-0',
+    # the result only in the movetext, and a game with no moves
+    '1. d4 d5 2. c4 1/2-1/2',
+    '[Event "empty"]\n\n*',
+    '[FEN "8/P3k3/8/8/8/8/8/4K3 w - - 0 1"]\n[SetUp "1"]\n\n1. a8=Q Kd6 *',
+))
+def test_read_summary(pgn):
+    assert read_summary(pgn) == summarize_game(read_game(pgn))
+
+def test_read_summary_skips_annotations():
+    summary = read_summary('1. e4 { best by test } e5 (1... c5 2. Nf3 { sicilian }) 2. Nf3 $1 *')
+    assert summary['pgn_movetext'] == '1. e4 e5 2. Nf3 *'
+    assert summary['ply_count'] == 3
+
+def test_read_header_summary():
+    pgn = '[White "a"]\n[Black "b"]\n[Date "2024.01.01"]\n\n1. e4 e5 *'
+    summary = read_header_summary(pgn)
+    assert summary['pgn_white'] == 'a'
+    assert summary['pgn_date'] == '2024.01.01'
+    # missing headers get the same defaults as a parsed game
+    assert summary['pgn_event'] == '?'
+    assert 'pgn_movetext' not in summary
+
+def test_iter_pgn_chunks():
+    text = ('[Event "tags only"]\n[White "x"]\n\n'
+            '[Event "comment"]\n\n1. e4 { a comment\n[Event "not a tag"] } e5 *\n\n'
+            '[Event "last"]\n\n1. d4 ; a line comment {\nd5 *\n')
+    chunks = list(iter_pgn_chunks(io.StringIO(text)))
+    # a game with only tags is a game of its own, and a tag-like line in a
+    #   comment doesn't start a game
+    assert [read_game(e).headers['Event'] for e in chunks] == ['tags only', 'comment', 'last']
+    assert read_game(chunks[1]).next().comment == 'a comment\n[Event "not a tag"]'
+    assert len(list(read_game(chunks[2]).mainline_moves())) == 2
+
+    # games without tags end at their termination marker, even several on
+    #   one line, but markers in comments and comments after them don't count
+    text = '1. e4 e5 *\n\n1. d4 { 1-0 } d5 0-1 1. c4 1/2-1/2 { drawn }\n1. Nf3 *\n'
+    chunks = list(iter_pgn_chunks(io.StringIO(text)))
+    assert [[m.uci() for m in read_game(e).mainline_moves()] for e in chunks] == [
+            ['e2e4', 'e7e5'], ['d2d4', 'd7d5'], ['c2c4'], ['g1f3']]
+    assert chunks[2] == ' 1. c4 1/2-1/2 { drawn }\n'
+    assert read_game(chunks[1]).next().comment == '1-0'
+
+def test_staged_games():
+    text = ''.join(f'[Round "{e}"]\n\n1. e4 e5 2. Nf3 *\n\n' for e in range(50))
+    games = [derive_game_data(e) for e in ingest_pgn(io.StringIO(text))]
+    staged = StagedGames(max_memory=1024)
+    for game_data in games:
+        staged.append(game_data)
+    # past max_memory they're kept on disk, and read back as often as needed
+    assert staged._file._rolled
+    assert len(staged) == 50
+    assert list(staged) == games
+    assert list(staged) == games
+    staged.close()
+
+def test_view_replays_encoded_moves(client, auth, app, monkeypatch):
+    auth.login()
+    client.post('/create', data={'title': 'encoded', 'body': '', 'pgn_file': (io.BytesIO(b'1. d4 d5 2. c4 e6 *'), 'game.pgn')})
+    with app.app_context():
+        db = get_db()
+        content = db.execute('SELECT id, moves FROM game_content WHERE id = 2').fetchone()
+        assert len(content['moves']) == 8
+
+    # the view's positions come from the encoded moves, not the pgn text
+    monkeypatch.setattr('doublecheck.game.read_game', None)
+    response = client.get('/game/2/positions.json')
+    assert [e['san'] for e in response.get_json()['positions']] == [None, 'd4', 'd5', 'c4', 'e6']
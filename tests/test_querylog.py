@@ -0,0 +1,85 @@
+#Doublecheck - A web-based chess game database.
+#Copyright (C) 2024 Nick Edner
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU Affero General Public License as published
+#by the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU Affero General Public License for more details.
+
+#You should have received a copy of the GNU Affero General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import pytest
+from flask import g
+
+from doublecheck.db import get_db
+from doublecheck.querylog import get_query_log, is_table_scan
+
+def test_queries_are_timed(app, query_log):
+    with app.app_context():
+        db = get_db()
+        rows = db.execute('SELECT id FROM post WHERE author_id = ?', (1,)).fetchall()
+        db.execute("UPDATE post SET title = 'timed'")
+        # each query in the app context is recorded, with the rows fetched or changed
+        select, update = g.queries[-2:]
+        assert select.sql == 'SELECT id FROM post WHERE author_id = ?'
+        assert select.parameters == 1
+        assert select.rows == len(rows) == 1
+        assert update.rows == 2
+        assert select.ms >= 0
+
+        # and added up for the process; fast statements aren't explained
+        stats = {e['sql']: e for e in query_log.slowest(count=100)}
+        assert stats[select.sql]['calls'] == 1
+        assert stats[select.sql]['rows'] == 1
+        assert stats[select.sql]['plan'] is None
+
+        for row in db.execute('SELECT id FROM post WHERE id = ?', (1,)):
+            pass
+        assert g.queries[-1].rows == 1
+
+def test_slow_queries(app, query_log):
+    query_log.slow_ms = 0
+    with app.app_context():
+        db = get_db()
+        db.execute('SELECT id FROM post WHERE author_id = ?', (1,)).fetchall()
+        db.execute('SELECT id FROM post WHERE id = ?', (1,)).fetchall()
+        slow = query_log.slow_queries()
+        assert slow[0]['sql'] == 'SELECT id FROM post WHERE id = ?'
+        assert slow[0]['plan'] is not None
+        # slow statements are explained, and listed if they scan a table
+        scans = {e['sql']: e for e in query_log.scans()}
+        assert any('post' in e for e in scans['SELECT id FROM post WHERE author_id = ?']['plan'])
+        assert 'SELECT id FROM post WHERE id = ?' not in scans
+
+def test_slow_queries_explained_once(app, query_log, monkeypatch):
+    explained = []
+    monkeypatch.setattr('doublecheck.querylog.explain', lambda db, sql, parameters=(): explained.append(sql) or [])
+    query_log.slow_ms = 0
+    with app.app_context():
+        for i in range(3):
+            get_db().execute('SELECT id FROM post WHERE id = ?', (i,)).fetchall()
+    assert explained == ['SELECT id FROM post WHERE id = ?']
+
+def test_query_log_disabled(app):
+    app.config['QUERY_LOG'] = False
+    app.config['DATABASE_PERSISTENT_CONNECTIONS'] = False
+    with app.app_context():
+        get_db().execute('SELECT 1').fetchone()
+        assert 'queries' not in g
+        assert get_query_log() is None
+
+@pytest.mark.parametrize(('detail', 'scan'), (
+    ('SCAN post', True),
+    ('SCAN TABLE post', True),
+    ('SCAN p USING INDEX post_created_id', False),
+    ('SCAN u USING COVERING INDEX sqlite_autoindex_user_1', False),
+    ('SEARCH u USING INTEGER PRIMARY KEY (rowid=?)', False),
+    ('SCAN CONSTANT ROW', False),
+))
+def test_is_table_scan(detail, scan):
+    assert is_table_scan(detail) == scan
@@ -0,0 +1,88 @@
+#Doublecheck - A web-based chess game database.
+#Copyright (C) 2024 Nick Edner
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU Affero General Public License as published
+#by the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU Affero General Public License for more details.
+
+#You should have received a copy of the GNU Affero General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import datetime
+
+import pytest
+from flask import session
+
+from doublecheck import create_app
+
+def get_session_cookie(client, app):
+    return client.get_cookie(app.config['SESSION_COOKIE_NAME'])
+
+def test_cookie_holds_only_session_id(client, app):
+    response = client.get('/game/1/view')
+    assert response.status_code == 200
+    cookie = get_session_cookie(client, app)
+    # the pgn stays on the server, the cookie is just an opaque id
+    assert len(cookie.value) < 64
+    assert 'e4' not in cookie.value
+
+    with client:
+        client.post('/game/1/view', data={'nextMove': 'true'})
+        assert session['game_view_id'] == 1
+        assert session['game_view_ply'] == 1
+
+def test_session_id_rotates_on_login(client, app, auth):
+    client.get('/game/1/view')
+    before_login = get_session_cookie(client, app).value
+    auth.login()
+    after_login = get_session_cookie(client, app).value
+    assert before_login != after_login
+
+    # the old id no longer refers to a session
+    with app.app_context():
+        store = app.session_interface.store
+        assert store.load(before_login, datetime.datetime.now()) is None
+
+@pytest.mark.parametrize('backend', ('sqlite', 'memory'))
+def test_backends(tmp_path, backend):
+    config = {
+            'TESTING': True,
+            'DATABASE': str(tmp_path / 'doublecheck.sqlite'),
+            'BOARD_CACHE_DIR': None,
+            'SESSION_BACKEND': backend,
+            'SESSION_DATABASE': str(tmp_path / 'sessions.sqlite'),
+            }
+    app = create_app(config)
+
+    @app.route('/session_test/<value>')
+    def set_value(value):
+        session['test_value'] = value
+        return ''
+
+    @app.route('/session_test')
+    def get_value():
+        return session.get('test_value', '')
+
+    client = app.test_client()
+    if backend == 'sqlite':
+        # the session db is only created once a session is saved
+        assert not (tmp_path / 'sessions.sqlite').exists()
+    client.get('/session_test/hello')
+    assert client.get('/session_test').data == b'hello'
+
+    if backend == 'sqlite':
+        # a second app (e.g. another worker) sees the same session
+        other_app = create_app(config)
+        other_app.add_url_rule('/session_test', view_func=get_value)
+        other_client = other_app.test_client()
+        other_client.set_cookie(app.config['SESSION_COOKIE_NAME'], get_session_cookie(client, app).value)
+        assert other_client.get('/session_test').data == b'hello'
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        create_app({'TESTING': True, 'SESSION_BACKEND': 'nope'})
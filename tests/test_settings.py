@@ -0,0 +1,72 @@
+#Doublecheck - A web-based chess game database.
+#Copyright (C) 2024 Nick Edner
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU Affero General Public License as published
+#by the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU Affero General Public License for more details.
+
+#You should have received a copy of the GNU Affero General Public License
+#along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import sqlite3
+
+from flask import g
+
+from doublecheck import create_app
+from doublecheck.settings import update_settings
+
+def test_settings_shared_between_workers(app, client):
+    # a second app on the same db stands in for another worker
+    other = create_app(dict(app.config))
+    other_client = other.test_client()
+    other_client.get('/')
+    assert not other.config['REGISTRATION_ENABLED']
+
+    with app.test_request_context('/', method='POST'):
+        update_settings({'REGISTRATION_ENABLED': True})
+    assert app.config['REGISTRATION_ENABLED']
+
+    # the other worker picks the change up on its next request
+    response = other_client.get('/')
+    assert other.config['REGISTRATION_ENABLED']
+    assert b'href="/auth/register"' in response.data
+
+def test_settings_checked_by_version(app, client, query_log):
+    client.get('/')
+    with client:
+        client.get('/')
+        # only the version row is read once the settings are loaded, and
+        #   users aren't counted again
+        queries = [e.sql for e in g.queries]
+        assert 'SELECT version FROM setting_version WHERE id = 1' in queries
+        assert 'SELECT name, value FROM setting' not in queries
+        assert 'SELECT 1 FROM user LIMIT 1' not in queries
+
+def test_first_user_checked_once(app, client):
+    # the test db already has users, so the first user isn't made an admin
+    app.config['CREATE_FIRST_USER_AS_ADMIN'] = True
+    client.get('/')
+    assert not app.config['CREATE_FIRST_USER_AS_ADMIN']
+
+def test_first_user_unresolved_while_locked(app, client, monkeypatch, caplog):
+    app.config['CREATE_FIRST_USER_AS_ADMIN'] = True
+    settings = app.extensions['settings']
+    def locked(app):
+        raise sqlite3.OperationalError('database is locked')
+    monkeypatch.setattr(settings, '_sync', locked)
+    client.get('/')
+    assert 'Settings not synced: database is locked' in caplog.text
+    # nobody is made an admin until users have been checked for
+    assert app.config['CREATE_FIRST_USER_AS_ADMIN']
+    assert not settings.first_user_is_admin(app)
+
+    # and the next request tries again
+    monkeypatch.undo()
+    client.get('/')
+    assert settings.first_user_checked
+    assert not app.config['CREATE_FIRST_USER_AS_ADMIN']